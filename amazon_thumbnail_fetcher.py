@@ -6,11 +6,25 @@ Amazonサムネイル画像自動取得ツール
 """
 
 import requests
+import urllib3
 import re
-from typing import Optional, Dict, List
+from abc import ABC, abstractmethod
+from typing import Callable, Optional, Dict, List, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+import heapq
+import itertools
 import logging
+import os
+import socket
+import threading
 import time
 
+from query_canonicalizer import canonicalize_query, normalize_search_text
+from extraction_engine import PriorityPattern, Text, decode, find_card_spans
+from local_catalog import LocalCatalog, relevance_scores
+
 try:
     from bs4 import BeautifulSoup
     BS4_AVAILABLE = True
@@ -21,11 +35,696 @@ except ImportError:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 上流リクエストの優先度クラス
+PRIORITY_INTERACTIVE = 'interactive'  # ウィジェットからの対話的な検索
+PRIORITY_REFRESH = 'refresh'  # 期限切れキャッシュのバックグラウンド更新
+PRIORITY_BULK = 'bulk'  # 一括インポートなどのバルク処理
+
+# ---------------------------------------------------------------------------
+# 検索結果カード（data-component-type="s-search-result"）からの抽出戦略
+# 上から順に試し、最初に値が取れたものを採用する。debug_search.py --profile で
+# 各戦略のヒット率とコストを計測できる。
+# ---------------------------------------------------------------------------
+
+def _join_span_texts(tag, limit: Optional[int] = None, min_length: int = 0) -> Optional[str]:
+    """タグ内のspanのテキストを結合（タイトルが複数のspanに分割されている場合に対応）"""
+    span_tags = tag.find_all('span')
+    if limit is not None:
+        span_tags = span_tags[:limit]
+    title_parts = []
+    for span in span_tags:
+        text = span.get_text(strip=True)
+        if text and len(text) > min_length:
+            title_parts.append(text)
+    return ' '.join(title_parts) if title_parts else None
+
+
+def _title_from_h2_link(result) -> Optional[str]:
+    """方法1: h2タグ内のaタグから（すべてのspanタグのテキストを結合）"""
+    h2_tag = result.find('h2')
+    a_tag = h2_tag.find('a') if h2_tag else None
+    return _join_span_texts(a_tag) if a_tag else None
+
+
+def _title_from_h2_text(result) -> Optional[str]:
+    """方法2: h2タグ内のすべてのテキストを取得"""
+    h2_tag = result.find('h2')
+    if not h2_tag:
+        return None
+    # 長すぎる場合は最初の部分のみ（著者名などが含まれる場合がある）
+    return h2_tag.get_text(strip=True)[:200] or None
+
+
+def _title_from_s_link(result) -> Optional[str]:
+    """方法3: aタグのs-linkクラスから（すべてのspanタグのテキストを結合）"""
+    a_tag = result.find('a', class_=lambda x: x and 's-link' in str(x))
+    return _join_span_texts(a_tag) if a_tag else None
+
+
+def _title_from_text_normal(result) -> Optional[str]:
+    """方法4: spanタグのa-text-normalクラスから（最初の3つまで）"""
+    span_tags = result.find_all('span', class_=lambda x: x and 'a-text-normal' in str(x))
+    title_parts = []
+    for span in span_tags[:3]:
+        text = span.get_text(strip=True)
+        if text and len(text) > 3:
+            title_parts.append(text)
+    return ' '.join(title_parts) if title_parts else None
+
+
+CARD_TITLE_STRATEGIES: List[Tuple[str, Callable]] = [
+    ('h2_link_spans', _title_from_h2_link),
+    ('h2_text', _title_from_h2_text),
+    ('s_link_spans', _title_from_s_link),
+    ('a_text_normal_spans', _title_from_text_normal),
+]
+
+# imgタグの探し方（最初に見つかったタグを使う）
+CARD_IMAGE_TAG_STRATEGIES: List[Tuple[str, Callable]] = [
+    ('img_s_image_class', lambda result: result.find('img', class_=lambda x: x and 's-image' in str(x))),
+    ('img_data_image_latency', lambda result: result.find('img', {'data-image-latency': True})),
+    ('img_any', lambda result: result.find('img')),
+]
+
+# imgタグから画像URLを読む属性（優先順位順）
+CARD_IMAGE_ATTRIBUTES = ['src', 'data-src', 'data-lazy-src', 'data-image-src', 'data-old-src']
+
+# imgタグから取れなかった場合に、カードのHTMLから探すAmazonの画像URLパターン
+CARD_IMAGE_PATTERNS: List[Tuple[str, str]] = [
+    ('media_ac_sl', r'https://m\.media-amazon\.com/images/I/[^"\s<>]+\._AC_SL\d+_[^"\s<>]*\.(jpg|png)'),
+    ('media_ac_ul', r'https://m\.media-amazon\.com/images/I/[^"\s<>]+\._AC_UL\d+_[^"\s<>]*\.(jpg|png)'),
+    ('media_ac_sy', r'https://m\.media-amazon\.com/images/I/[^"\s<>]+\._AC_SY\d+_[^"\s<>]*\.(jpg|png)'),
+    ('ssl_ac_sl', r'https://images-na\.ssl-images-amazon\.com/images/I/[^"\s<>]+\._AC_SL\d+_[^"\s<>]*\.(jpg|png)'),
+    ('ssl_sl', r'https://images-na\.ssl-images-amazon\.com/images/I/[^"\s<>]+\._SL\d+_[^"\s<>]*\.(jpg|png)'),
+]
+
+
+def extract_card_title(result) -> Tuple[Optional[str], Optional[str]]:
+    """検索結果カードからタイトルを抽出。(タイトル, 使った戦略名)"""
+    for name, strategy in CARD_TITLE_STRATEGIES:
+        title = strategy(result)
+        if title:
+            return title, name
+    return None, None
+
+
+def extract_card_thumbnail(result, raw: Optional[bytes] = None,
+                           span: Optional[Tuple[int, int]] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    検索結果カードから画像URLを抽出。(画像URL, 使った戦略名)
+    
+    raw（レスポンスの生のバイト列）とカードの範囲spanが渡された場合、正規表現は
+    その範囲に直接適用し、str(result) による再シリアライズを行いません。
+    """
+    # 方法1: imgタグを探す（複数のパターンを試す）
+    for name, find_img in CARD_IMAGE_TAG_STRATEGIES:
+        img_tag = find_img(result)
+        if img_tag:
+            for attribute in CARD_IMAGE_ATTRIBUTES:
+                thumbnail_url = img_tag.get(attribute)
+                if thumbnail_url:
+                    return thumbnail_url, name
+            break
+    
+    # 方法2: 正規表現で画像URLを探す（検索結果のHTMLから）
+    if raw is not None and span is not None:
+        thumbnail_url, name = CARD_IMAGE_ENGINE.search(raw, *span)
+    else:
+        thumbnail_url, name = CARD_IMAGE_ENGINE.search(str(result))
+    return decode(thumbnail_url), name
+
+
+# 商品ページから画像URL・タイトルを探すパターン（上から順に試す）
+PRODUCT_IMAGE_PATTERNS: List[Tuple[str, str]] = [
+    # メタタグから取得を試みる（最も確実）
+    ('og_image', r'<meta\s+property="og:image"\s+content="([^"]+)"'),
+    ('ssl_sl_jpg', r'https://images-na\.ssl-images-amazon\.com/images/I/[^"\s]+\._SL\d+_\.jpg'),
+    ('media_sl_jpg', r'https://m\.media-amazon\.com/images/I/[^"\s]+\._SL\d+_\.jpg'),
+]
+
+PRODUCT_TITLE_PATTERNS: List[Tuple[str, str]] = [
+    ('product_title_span', r'<span[^>]*id="productTitle"[^>]*>([^<]+)</span>'),
+    ('h1_title_span', r'<h1[^>]*id="title"[^>]*>.*?<span[^>]*>([^<]+)</span>'),
+    ('og_title', r'<meta\s+property="og:title"\s+content="([^"]+)"'),
+]
+
+
+def _clean_title(title: str) -> str:
+    """HTMLエンティティをデコードし、余分な空白を削除"""
+    title = title.strip()
+    title = title.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
+    return ' '.join(title.split())
+
+
+# BeautifulSoupが使えない場合に、検索結果ページのdata-asin周辺から探すタイトルパターン
+SEARCH_CONTEXT_TITLE_PATTERNS: List[Tuple[str, str]] = [
+    # パターン1: h2タグ内のタイトル（最も一般的なパターン）
+    ('h2_link_span', r'<h2[^>]*>.*?<a[^>]*>.*?<span[^>]*>([^<]+)</span>'),
+    # パターン2: aタグ内のタイトル（s-linkクラス）
+    ('s_link_span', r'<a[^>]*class="[^"]*s-link[^"]*"[^>]*>.*?<span[^>]*>([^<]+)</span>'),
+    # パターン3: spanタグ内のタイトル（a-text-normalクラス）
+    ('a_text_normal_span', r'<span[^>]*class="[^"]*a-text-normal[^"]*"[^>]*>([^<]+)</span>'),
+    # パターン4: より広範囲で検索（10文字以上のテキスト）
+    ('any_long_span', r'<span[^>]*>([^<]{10,150})</span>'),
+]
+
+
+def _is_meaningful_title(raw_title: Text) -> bool:
+    """意味のあるタイトルかチェック（3文字以上、かつ「タイトル不明」などの無意味な文字列でない）"""
+    title = _clean_title(decode(raw_title))
+    return len(title) > 3 and title.lower() not in ['タイトル不明', 'title', '商品名']
+
+
+def _is_long_enough_title(raw_title: Text) -> bool:
+    return len(_clean_title(decode(raw_title))) > 3
+
+
+def extract_context_title(context: str) -> Tuple[Optional[str], Optional[str]]:
+    """検索結果ページのdata-asin周辺のHTMLからタイトルを抽出。(タイトル, 使ったパターン名)"""
+    title, name = SEARCH_CONTEXT_TITLE_ENGINE.search(context, validate=_is_meaningful_title)
+    if title is None:
+        return None, None
+    # 著者名やシリーズ名が含まれている可能性があるので、長めに取得
+    return _clean_title(title)[:200], name
+
+
+def extract_product_thumbnail(html: Text) -> Tuple[Optional[str], Optional[str]]:
+    """商品ページのHTML（文字列または生のバイト列）から画像URLを抽出。(画像URL, 使ったパターン名)"""
+    thumbnail_url, name = PRODUCT_IMAGE_ENGINE.search(html)
+    return decode(thumbnail_url), name
+
+
+def extract_product_title(html: Text) -> Tuple[Optional[str], Optional[str]]:
+    """商品ページのHTML（文字列または生のバイト列）からタイトルを抽出。(タイトル, 使ったパターン名)"""
+    title, name = PRODUCT_TITLE_ENGINE.search(html, validate=_is_long_enough_title)
+    if title is None:
+        return None, None
+    return _clean_title(decode(title))[:200], name
+
+
+# 各パターン表を優先順位付きのパターンとしてコンパイル（インポート時に1回だけ）
+CARD_IMAGE_ENGINE = PriorityPattern(CARD_IMAGE_PATTERNS)
+PRODUCT_IMAGE_ENGINE = PriorityPattern(PRODUCT_IMAGE_PATTERNS, first_group=True)
+PRODUCT_TITLE_ENGINE = PriorityPattern(PRODUCT_TITLE_PATTERNS, re.DOTALL | re.IGNORECASE, first_group=True)
+# 文字数を数えるパターン（{10,150}）を含むので、文字列にだけ適用する
+SEARCH_CONTEXT_TITLE_ENGINE = PriorityPattern(SEARCH_CONTEXT_TITLE_PATTERNS, re.DOTALL | re.IGNORECASE,
+                                              first_group=True)
+
+
+class DeadlineExceeded(Exception):
+    """リクエスト全体の期限を過ぎたため、上流への問い合わせを打ち切った"""
+    pass
+
+
+class Deadline:
+    """1リクエスト全体の期限と優先度クラス（各上流呼び出しは残り時間だけを使う）"""
+    
+    def __init__(self, seconds: float, priority: str = PRIORITY_INTERACTIVE):
+        self.expires_at = time.monotonic() + seconds
+        self.priority = priority
+        self._cancelled = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._callbacks_lock = threading.Lock()
+    
+    def child(self) -> 'Deadline':
+        """同じ期限・優先度で、個別に打ち切れる期限を作る"""
+        child = Deadline(0, self.priority)
+        child.expires_at = self.expires_at
+        return child
+    
+    def cancel(self):
+        """期限を待たずに打ち切る（以降の問い合わせはDeadlineExceeded）"""
+        with self._callbacks_lock:
+            self._cancelled.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+    
+    def add_cancel_callback(self, callback: Callable[[], None]):
+        """打ち切られたときに呼ぶ関数を登録（打ち切り済みならすぐに呼ぶ）"""
+        with self._callbacks_lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+    
+    def remove_cancel_callback(self, callback: Callable[[], None]):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+    
+    def remaining(self) -> float:
+        if self._cancelled.is_set():
+            return 0.0
+        return self.expires_at - time.monotonic()
+    
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+    
+    def clamp(self, timeout: float) -> float:
+        """タイムアウトを残り時間以内に切り詰める。期限切れならDeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("リクエストの期限を過ぎました")
+        return min(timeout, remaining)
+    
+    def sleep(self, seconds: float):
+        """再試行の待機。打ち切られるか期限を過ぎる場合はDeadlineExceeded"""
+        if seconds >= self.remaining() or self._cancelled.wait(seconds):
+            raise DeadlineExceeded("リクエストの期限を過ぎました")
+
+
+def read_body(response: requests.Response, deadline: Optional[Deadline] = None,
+              chunk_size: int = 64 * 1024) -> requests.Response:
+    """
+    stream=True で受け取ったレスポンスの本文を期限内に読み切る
+    
+    requestsのtimeoutは接続と受信の間隔にしか効かず、少しずつ届くレスポンスは
+    いつまでも読み続けてしまうため、受信のたびに残り時間を確認し、ソケットの
+    タイムアウトも残り時間に切り詰めます。期限を過ぎたら接続を閉じてDeadlineExceeded。
+    """
+    chunks = []
+    sock = getattr(response.raw.connection, 'sock', None) if response.raw.connection else None
+    read_timeout = sock.gettimeout() if sock is not None else None
+    try:
+        while True:
+            if deadline:
+                remaining = deadline.clamp(read_timeout if read_timeout is not None else float('inf'))
+                if sock is not None:
+                    sock.settimeout(remaining)
+            chunk = response.raw.read1(chunk_size, decode_content=True)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (urllib3.exceptions.ReadTimeoutError, socket.timeout) as e:
+        response.raw.close()
+        if deadline and deadline.expired():
+            raise DeadlineExceeded("本文の受信中にリクエストの期限を過ぎました") from e
+        raise requests.exceptions.ReadTimeout(e, request=response.request) from e
+    except BaseException:
+        response.raw.close()
+        raise
+    response._content = b''.join(chunks)
+    response._content_consumed = True
+    response.close()
+    return response
+
+
+class LatencyTracker:
+    """直近のレイテンシを記録し、パーセンタイルを計算する"""
+    
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+    
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+    
+    def percentile(self, q: float) -> Optional[float]:
+        """q（0〜100）パーセンタイルを返す。サンプルがなければNone"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))
+        return samples[index]
+    
+    def adaptive_timeout(self, ceiling: float, floor: float = 3.0, multiplier: float = 3.0,
+                         q: float = 99, min_samples: int = 20) -> float:
+        """
+        観測したレイテンシに基づくタイムアウト
+        
+        サンプルが十分あれば p99 の multiplier 倍を [floor, ceiling] に収めた値、
+        なければ ceiling を返します。
+        """
+        if self.count() < min_samples:
+            return ceiling
+        return min(ceiling, max(floor, self.percentile(q) * multiplier))
+
+
+class CoverProvider(ABC):
+    """ISBNから表紙画像URLを取得するプロバイダーの基底クラス"""
+    
+    name = 'base'
+    
+    def __init__(self):
+        self.latency = LatencyTracker()
+    
+    @abstractmethod
+    def get_cover_by_isbn(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        """ISBNから表紙画像URLを取得。見つからない場合はNone"""
+    
+    def request_timeout(self, ceiling: float, deadline: Optional[Deadline] = None) -> float:
+        """このプロバイダーへの1回の問い合わせに使うタイムアウト"""
+        timeout = self.latency.adaptive_timeout(ceiling)
+        return deadline.clamp(timeout) if deadline else timeout
+    
+    def fetch(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        """レイテンシを記録しながら取得（例外はNoneとして扱う）"""
+        start = time.monotonic()
+        try:
+            return self.get_cover_by_isbn(isbn, deadline)
+        except DeadlineExceeded:
+            logger.warning(f"{self.name}: 期限切れのため問い合わせを中止しました")
+            return None
+        except Exception as e:
+            logger.error(f"{self.name}: 表紙画像の取得エラー: {e}")
+            return None
+        finally:
+            self.latency.record(time.monotonic() - start)
+
+
+class AmazonCoverProvider(CoverProvider):
+    """amazon.co.jpの商品ページをスクレイピングするプロバイダー"""
+    
+    name = 'amazon'
+    
+    def __init__(self, fetcher: 'AmazonThumbnailFetcher'):
+        super().__init__()
+        self.fetcher = fetcher
+    
+    def get_cover_by_isbn(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        return self.fetcher._get_thumbnail_by_isbn_from_amazon(isbn, deadline)
+
+
+class OpenBDCoverProvider(CoverProvider):
+    """openBD（版元ドットコム）の書誌APIから表紙画像を取得するプロバイダー"""
+    
+    name = 'openbd'
+    
+    def __init__(self, base_url: str = "https://api.openbd.jp", session: Optional[requests.Session] = None,
+                 timeout: float = 10):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+        self.session = session or requests.Session()
+        self.timeout = timeout
+    
+    def get_cover_by_isbn(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        isbn_clean = isbn.replace('-', '').replace(' ', '')
+        response = self.session.get(f"{self.base_url}/v1/get", params={'isbn': isbn_clean},
+                                    timeout=self.request_timeout(self.timeout, deadline), stream=True)
+        response = read_body(response, deadline)
+        response.raise_for_status()
+        # 見つからない場合は [null] が返る
+        books = response.json()
+        if not books or not books[0]:
+            return None
+        return books[0].get('summary', {}).get('cover') or None
+
+
+class OpenLibraryCoverProvider(CoverProvider):
+    """Open Library Covers APIから表紙画像を取得するプロバイダー"""
+    
+    name = 'openlibrary'
+    
+    def __init__(self, base_url: str = "https://covers.openlibrary.org", session: Optional[requests.Session] = None,
+                 timeout: float = 10):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+        self.session = session or requests.Session()
+        self.timeout = timeout
+    
+    def get_cover_by_isbn(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        isbn_clean = isbn.replace('-', '').replace(' ', '')
+        cover_url = f"{self.base_url}/b/isbn/{isbn_clean}-L.jpg"
+        # default=false を付けると、画像がない場合に空画像ではなく404が返る
+        response = self.session.head(cover_url, params={'default': 'false'}, timeout=self.request_timeout(self.timeout, deadline),
+                                     allow_redirects=True)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return cover_url
+
+
+class CoverResolver:
+    """
+    複数のプロバイダーにヘッジリクエストを送って表紙画像を解決する
+    
+    先頭のプロバイダーから順に問い合わせ、そのプロバイダーのp95レイテンシ以内に
+    応答がなければ次のプロバイダーにも並行して問い合わせ、最初に得られた有効な結果を返します。
+    応答が無効（None）だった場合は待たずに次のプロバイダーへ進みます。
+    結果が決まった（または期限を過ぎた）時点で、残りの問い合わせは打ち切ります。
+    """
+    
+    def __init__(self, providers: Optional[List[CoverProvider]] = None, hedge_percentile: float = 95,
+                 min_hedge_delay: float = 0.5, max_hedge_delay: float = 10.0,
+                 default_hedge_delay: float = 3.0, min_samples: int = 20, max_workers: int = 8,
+                 default_deadline_seconds: float = 120):
+        self.providers: List[CoverProvider] = list(providers or [])
+        self.default_deadline_seconds = default_deadline_seconds
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.min_samples = min_samples
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cover')
+    
+    def register(self, provider: CoverProvider):
+        """プロバイダーを末尾（最も優先度が低い位置）に登録"""
+        self.providers.append(provider)
+    
+    def hedge_delay(self, provider: CoverProvider) -> float:
+        """次のプロバイダーに問い合わせるまでの待ち時間（p95に基づく）"""
+        if provider.latency.count() < self.min_samples:
+            return self.default_hedge_delay
+        delay = provider.latency.percentile(self.hedge_percentile)
+        return min(self.max_hedge_delay, max(self.min_hedge_delay, delay))
+    
+    @staticmethod
+    def _is_valid(result: Optional[str]) -> bool:
+        return bool(result) and result.startswith(('http://', 'https://'))
+    
+    def resolve(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        """ISBNから表紙画像URLを解決（期限を過ぎた場合はDeadlineExceeded）"""
+        if deadline is None:
+            deadline = Deadline(self.default_deadline_seconds)
+        # プロバイダーごとに打ち切れる期限を渡し、負けた問い合わせが実行枠を握り続けないようにする
+        pending: Dict = {}
+        next_index = 0
+        
+        try:
+            while next_index < len(self.providers) or pending:
+                timeout = float('inf')
+                if next_index < len(self.providers):
+                    provider = self.providers[next_index]
+                    next_index += 1
+                    provider_deadline = deadline.child()
+                    future = self._executor.submit(provider.fetch, isbn, provider_deadline)
+                    pending[future] = (provider, provider_deadline)
+                    if next_index < len(self.providers):
+                        timeout = self.hedge_delay(provider)
+                
+                done, _ = wait(pending, timeout=deadline.clamp(timeout), return_when=FIRST_COMPLETED)
+                for future in done:
+                    provider, _ = pending.pop(future)
+                    result = future.result()
+                    if self._is_valid(result):
+                        logger.info(f"表紙画像を取得 ({provider.name}): {result}")
+                        return result
+                    logger.info(f"{provider.name}: 表紙画像が見つかりませんでした")
+                if not done and deadline.expired():
+                    raise DeadlineExceeded("表紙画像の解決が期限内に終わりませんでした")
+                if not done and timeout != float('inf'):
+                    logger.info(f"{self.providers[next_index - 1].name}: {timeout:.2f}秒以内に応答がないためヘッジします")
+        finally:
+            for future, (provider, provider_deadline) in pending.items():
+                future.cancel()
+                provider_deadline.cancel()
+                logger.info(f"{provider.name}: 不要になった問い合わせを打ち切ります")
+        
+        return None
+
+
+class RefreshScheduler:
+    """
+    期限切れキャッシュのバックグラウンド更新
+    
+    同じキーの更新は1つだけ受け付け、少数のワーカースレッドで同時実行数を制限します。
+    待ち行列ではアクセス数の多い（人気の）キーを優先し、満杯の場合は最も優先度の低い待ちを捨てます。
+    """
+    
+    def __init__(self, max_workers: int = 2, max_pending: int = 32):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._heap: List[Tuple[int, int, Tuple, Callable[[], None]]] = []
+        self._pending_keys = set()
+        self._running_keys = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+    
+    def submit(self, key: Tuple, priority: int, refresh: Callable[[], None]) -> bool:
+        """更新を予約（priorityが大きいほど先に実行）。受け付けなかった場合はFalse"""
+        with self._cond:
+            if key in self._pending_keys or key in self._running_keys:
+                return False
+            if len(self._heap) >= self.max_pending:
+                lowest = max(self._heap)
+                if -lowest[0] >= priority:
+                    logger.info(f"更新待ちが満杯のため見送ります: {key}")
+                    return False
+                self._heap.remove(lowest)
+                heapq.heapify(self._heap)
+                self._pending_keys.discard(lowest[2])
+            heapq.heappush(self._heap, (-priority, next(self._seq), key, refresh))
+            self._pending_keys.add(key)
+            self._ensure_workers()
+            self._cond.notify()
+            return True
+    
+    def stats(self) -> Dict[str, int]:
+        """待ち・実行中の更新数"""
+        with self._cond:
+            return {'pending': len(self._heap), 'running': len(self._running_keys)}
+    
+    def _ensure_workers(self):
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name=f"refresh-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+    
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, key, refresh = heapq.heappop(self._heap)
+                self._pending_keys.discard(key)
+                self._running_keys.add(key)
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"バックグラウンド更新エラー ({key}): {e}")
+            finally:
+                with self._cond:
+                    self._running_keys.discard(key)
+
+
+class UpstreamScheduler:
+    """
+    Amazonへのリクエスト（検索・商品ページ）の優先度付きスケジューラー
+    
+    優先度クラスごとに待ち行列を持ち、重み付き公平キューイング（開始時刻タグ方式）で
+    次に実行するリクエストを選びます。全体とクラスごとの同時実行数に上限があり、
+    バルク処理が走っていてもウィジェットからの対話的なリクエストが待たされないようにします。
+    
+    スケジューラーはプロセスごとなので、gunicornは1ワーカー・max_concurrency以上のスレッド
+    （gthread）で動かします（Procfile・render.yaml）。
+    """
+    
+    # クラス名: (重み, 同時実行数の上限)
+    DEFAULT_CLASSES = {
+        PRIORITY_INTERACTIVE: (8, 4),
+        PRIORITY_REFRESH: (2, 1),
+        PRIORITY_BULK: (1, 1),
+    }
+    
+    def __init__(self, max_concurrency: int = 4, classes: Optional[Dict[str, Tuple[float, int]]] = None):
+        self.max_concurrency = max_concurrency
+        self.classes = dict(classes or self.DEFAULT_CLASSES)
+        self._cond = threading.Condition()
+        self._queues: Dict[str, deque] = {name: deque() for name in self.classes}
+        self._running: Dict[str, int] = {name: 0 for name in self.classes}
+        self._dispatched: Dict[str, int] = {name: 0 for name in self.classes}
+        self._last_tag: Dict[str, float] = {name: 0.0 for name in self.classes}
+        self._virtual_time = 0.0
+        self._total_running = 0
+        self.wait_time: Dict[str, LatencyTracker] = {name: LatencyTracker() for name in self.classes}
+    
+    @contextmanager
+    def slot(self, priority: str, deadline: Optional[Deadline] = None):
+        """実行枠を確保するコンテキストマネージャ（期限までに確保できなければDeadlineExceeded）"""
+        self._acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self._release(priority)
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """クラスごとの待ち行列の長さ・実行中の数・待ち時間（秒）"""
+        with self._cond:
+            snapshot = {
+                name: {
+                    'queued': len(self._queues[name]),
+                    'running': self._running[name],
+                    'dispatched': self._dispatched[name],
+                }
+                for name in self.classes
+            }
+        for name, tracker in self.wait_time.items():
+            snapshot[name]['wait_p50'] = tracker.percentile(50) or 0.0
+            snapshot[name]['wait_p95'] = tracker.percentile(95) or 0.0
+        return snapshot
+    
+    def _acquire(self, priority: str, deadline: Optional[Deadline]):
+        if priority not in self.classes:
+            raise ValueError(f"不明な優先度クラスです: {priority}")
+        weight, _ = self.classes[priority]
+        start = time.monotonic()
+        # 打ち切られた（ヘッジで負けた）リクエストは、期限を待たずにすぐ待ち行列から外す
+        wake = self._wake
+        if deadline:
+            deadline.add_cancel_callback(wake)
+        try:
+            with self._cond:
+                tag = max(self._last_tag[priority], self._virtual_time) + 1 / weight
+                self._last_tag[priority] = tag
+                waiter = {'tag': tag, 'granted': False}
+                self._queues[priority].append(waiter)
+                self._dispatch()
+                while not waiter['granted']:
+                    timeout = deadline.remaining() if deadline else None
+                    if timeout is not None and timeout <= 0:
+                        self._queues[priority].remove(waiter)
+                        raise DeadlineExceeded("上流リクエストの実行枠を期限内に確保できませんでした")
+                    self._cond.wait(timeout)
+        finally:
+            if deadline:
+                deadline.remove_cancel_callback(wake)
+        self.wait_time[priority].record(time.monotonic() - start)
+    
+    def _wake(self):
+        """待っているスレッドを起こして期限を確認させる"""
+        with self._cond:
+            self._cond.notify_all()
+    
+    def _release(self, priority: str):
+        with self._cond:
+            self._running[priority] -= 1
+            self._total_running -= 1
+            self._dispatch()
+    
+    def _dispatch(self):
+        """空いている枠に、タグの最も小さい待ちを割り当てる（ロック取得済みで呼ぶ）"""
+        granted = False
+        while self._total_running < self.max_concurrency:
+            candidates = [
+                (queue[0]['tag'], name) for name, queue in self._queues.items()
+                if queue and self._running[name] < self.classes[name][1]
+            ]
+            if not candidates:
+                break
+            tag, name = min(candidates)
+            self._queues[name].popleft()['granted'] = True
+            self._running[name] += 1
+            self._dispatched[name] += 1
+            self._total_running += 1
+            self._virtual_time = tag
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
 
 class AmazonThumbnailFetcher:
     """Amazonのサムネイル画像を取得するクラス"""
     
-    def __init__(self):
+    def __init__(self, catalog_path: Optional[str] = None,
+                 cover_providers: Optional[List[CoverProvider]] = None):
         self.amazon_base_url = "https://www.amazon.co.jp"
         self.amazon_image_base = "https://images-na.ssl-images-amazon.com/images"
         # ブラウザのようなリクエストヘッダー（ボット検出を回避）
@@ -46,7 +745,69 @@ class AmazonThumbnailFetcher:
         # セッションを使用してクッキーを保持（より現実的なブラウザセッションをシミュレート）
         self.session = requests.Session()
         self.session.headers.update(self.headers)
+        # 検索結果のキャッシュ（キーは正規化済みクエリと件数）
+        # cache_ttlを過ぎた結果もcache_max_staleまではそのまま返し、裏で更新する（stale-while-revalidate）
+        # ローカルカタログの結果（タイトル検索・ASIN）にも同じ規則を適用する
+        self.search_cache_size = 512
+        self.cache_ttl = 24 * 60 * 60
+        self.cache_max_stale = 30 * 24 * 60 * 60
+        self.refresh_retry_interval = 5 * 60
+        self.refresh_deadline_seconds = 60
+        self._search_cache: "OrderedDict[Tuple[str, int], Dict]" = OrderedDict()
+        self._search_cache_lock = threading.Lock()
+        # カタログから返したASINごとのアクセス数と更新の予約時刻（更新の優先度に使う）
+        self.asin_stats_size = 4096
+        self._asin_stats: "OrderedDict[str, Dict]" = OrderedDict()
+        self.refresh_scheduler = RefreshScheduler()
+        # Amazonへのリクエストはすべてこのスケジューラーを通す
+        self.upstream_scheduler = UpstreamScheduler()
+        # 解決済み候補のローカルカタログ（タイトル検索はまずここから引く）
+        if catalog_path is None:
+            catalog_path = os.environ.get(
+                'THUMBNAIL_CATALOG_PATH',
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+            )
+        self.catalog = LocalCatalog(catalog_path)
+        # ISBNで表紙画像を引くプロバイダー（先頭が優先。Amazonが遅い場合は後続にヘッジする）
+        if cover_providers is None:
+            cover_providers = [AmazonCoverProvider(self), OpenBDCoverProvider()]
+        self.cover_resolver = CoverResolver(cover_providers)
+        # エンドポイントごとの観測レイテンシ（タイムアウトの自動調整に使う）
+        self.latency: Dict[str, LatencyTracker] = {
+            'search': LatencyTracker(),
+            'product_page': LatencyTracker(),
+        }
+        
+    def _get(self, endpoint: str, url: str, ceiling: float, deadline: Optional[Deadline] = None,
+             **kwargs) -> requests.Response:
+        """
+        上流へのGETリクエスト
         
+        優先度クラス（deadline.priority）ごとのスケジューラーで実行枠を確保してから送信します。
+        タイムアウトはエンドポイントの観測レイテンシから決め（最大ceiling秒）、
+        さらにリクエスト全体の残り時間で切り詰めます。本文はストリーミングで受信し、
+        受信中に期限を過ぎた場合も打ち切ります（read_body）。
+        """
+        priority = deadline.priority if deadline else PRIORITY_INTERACTIVE
+        tracker = self.latency[endpoint]
+        # 打ち切られた・期限切れのリクエストは実行枠を待たない
+        if deadline and deadline.expired():
+            raise DeadlineExceeded("リクエストの期限を過ぎました")
+        with self.upstream_scheduler.slot(priority, deadline):
+            adaptive = tracker.adaptive_timeout(ceiling)
+            timeout = deadline.clamp(adaptive) if deadline else adaptive
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, timeout=timeout, stream=True, **kwargs)
+                return read_body(response, deadline)
+            except requests.exceptions.Timeout as e:
+                # 残り時間で切り詰めたタイムアウトに達した場合は期限切れとして扱う
+                if timeout < adaptive:
+                    raise DeadlineExceeded("リクエストの期限を過ぎました") from e
+                raise
+            finally:
+                tracker.record(time.monotonic() - start)
+    
     def extract_asin_from_url(self, url: str) -> Optional[str]:
         """Amazon URLからASINを抽出"""
         # ASINは10文字の英数字
@@ -74,8 +835,120 @@ class AmazonThumbnailFetcher:
         
         return None
     
-    def search_amazon_by_title(self, title: str, max_results: int = 1) -> List[Dict[str, str]]:
-        """タイトルでAmazonを検索して複数の結果を取得（書籍のみ）"""
+    def search_amazon_by_title(self, title: str, max_results: int = 1,
+                               deadline: Optional[Deadline] = None) -> List[Dict[str, str]]:
+        """タイトルでAmazonを検索して複数の結果を取得（書籍のみ）
+        
+        表記揺れを吸収するため、キャッシュとカタログは正規化したクエリで引きます。
+        正規形は記号や巻数表記を落とすので、Amazonには入力をほぼそのまま（NFKCと空白の統一のみ）送ります。
+        """
+        query = canonicalize_query(title)
+        search_text = normalize_search_text(title)
+        if not query:
+            logger.warning(f"正規化後のクエリが空です: {title!r}")
+            return []
+        
+        cache_key = (query, max_results)
+        cached = self._get_cached_search(cache_key)
+        if cached is not None:
+            return cached
+        
+        # 同じ検索語を以前に解決していれば、その結果をカタログから再現する。なければ
+        # 確度の高い候補がmax_results件そろう場合に限り、カタログの検索結果を使う
+        # （古すぎる候補は使わず、期限切れの候補はキャッシュと同様に返しつつ裏で更新する）
+        results = self.catalog.lookup(query, max_results, max_age=self.cache_max_stale)
+        if not results:
+            results = self.catalog.search(query, max_results, max_age=self.cache_max_stale)
+            if len(results) < max_results:
+                results = []
+        if results:
+            logger.info(f"カタログから {len(results)} 件の候補を取得: {query}")
+            fetched_at = min(r.pop('fetched_at') for r in results)
+            self._store_search_cache(cache_key, results, search_text, fetched_at)
+            return self._get_cached_search(cache_key) or results
+        
+        results = self._search_amazon(search_text, max_results, deadline)
+        if deadline and deadline.expired():
+            # 期限切れで途中までしか解析できなかった結果は、完全な結果としてはキャッシュしない
+            logger.warning(f"期限切れで検索が途中で終わったため、結果をキャッシュしません: {query}")
+            self.catalog.add(results)
+            return results
+        self.catalog.add(results, query, max_results)
+        self._store_search_cache(cache_key, results, search_text)
+        return results
+    
+    def _get_cached_search(self, cache_key: Tuple[str, int]) -> Optional[List[Dict[str, str]]]:
+        """
+        キャッシュから検索結果を取得
+        
+        期限切れでも使える範囲の結果はそのまま返し、バックグラウンド更新を予約します。
+        使えない（キャッシュにない、または古すぎる）場合はNone
+        """
+        now = time.monotonic()
+        with self._search_cache_lock:
+            entry = self._search_cache.get(cache_key)
+            if entry is None:
+                return None
+            age = time.time() - entry['fetched_at']
+            if age > self.cache_max_stale:
+                del self._search_cache[cache_key]
+                return None
+            self._search_cache.move_to_end(cache_key)
+            entry['hits'] += 1
+            results = [dict(r) for r in entry['results']]
+            hits = entry['hits']
+            search_text = entry['search_text']
+            needs_refresh = (age > self.cache_ttl
+                             and now - entry['refresh_requested_at'] >= self.refresh_retry_interval)
+            if needs_refresh:
+                entry['refresh_requested_at'] = now
+        
+        if needs_refresh:
+            logger.info(f"期限切れのキャッシュを返し、バックグラウンドで更新します: {cache_key[0]}")
+            self.refresh_scheduler.submit(cache_key, hits, lambda: self._refresh_search(cache_key, search_text))
+        else:
+            logger.info(f"キャッシュヒット: {cache_key[0]}")
+        return results
+    
+    def _store_search_cache(self, cache_key: Tuple[str, int], results: List[Dict[str, str]],
+                            search_text: str, fetched_at: Optional[float] = None):
+        """
+        検索結果をキャッシュ（失敗（503など）で空になった結果はキャッシュしない）
+        
+        search_text は更新時にAmazonへ送る検索語、fetched_at は結果を上流から取得した日時
+        （UNIX時刻。省略時は現在時刻）
+        """
+        if not results:
+            return
+        with self._search_cache_lock:
+            previous = self._search_cache.get(cache_key)
+            self._search_cache[cache_key] = {
+                'results': [dict(r) for r in results],
+                'search_text': search_text,
+                'fetched_at': fetched_at if fetched_at is not None else time.time(),
+                'refresh_requested_at': float('-inf'),
+                'hits': previous['hits'] if previous else 0,
+            }
+            self._search_cache.move_to_end(cache_key)
+            while len(self._search_cache) > self.search_cache_size:
+                self._search_cache.popitem(last=False)
+    
+    def _refresh_search(self, cache_key: Tuple[str, int], search_text: str):
+        """期限切れのキャッシュをAmazonから取り直す（バックグラウンド実行）"""
+        query, max_results = cache_key
+        deadline = Deadline(self.refresh_deadline_seconds, PRIORITY_REFRESH)
+        results = self._search_amazon(search_text, max_results, deadline)
+        if results and not deadline.expired():
+            self.catalog.add(results, query, max_results)
+            self._store_search_cache(cache_key, results, search_text)
+            logger.info(f"キャッシュを更新しました: {query}")
+        else:
+            # 取得に失敗した場合は古い結果を残し、refresh_retry_interval後に再試行する
+            logger.warning(f"キャッシュの更新に失敗しました: {query}")
+    
+    def _search_amazon(self, title: str, max_results: int = 1,
+                       deadline: Optional[Deadline] = None) -> List[Dict[str, str]]:
+        """Amazonの検索ページを取得して結果を解析（キャッシュなし）"""
         # 例外が起きても必ず参照できるように、先に初期化しておく
         results: List[Dict[str, str]] = []
         
@@ -95,14 +968,20 @@ class AmazonThumbnailFetcher:
         for attempt in range(max_retries):
             try:
                 # セッションを使用してリクエスト（クッキーを保持）
-                response = self.session.get(search_url, params=params, timeout=30)
+                response = self._get('search', search_url, 30, deadline, params=params)
                 
                 # 503エラーの場合はリトライ
                 if response.status_code == 503:
                     if attempt < max_retries - 1:
                         wait_time = retry_delay * (2 ** attempt)  # 指数バックオフ: 2秒、4秒、8秒
+                        if deadline and deadline.remaining() <= wait_time:
+                            logger.error(f"Amazon 503エラー: 期限内に再試行できないため中止します")
+                            return results
                         logger.warning(f"Amazon 503エラー (試行 {attempt + 1}/{max_retries})。{wait_time}秒後に再試行します...")
-                        time.sleep(wait_time)
+                        if deadline:
+                            deadline.sleep(wait_time)
+                        else:
+                            time.sleep(wait_time)
                         continue
                     else:
                         logger.error(f"Amazon 503エラー: 最大リトライ回数に達しました")
@@ -115,8 +994,13 @@ class AmazonThumbnailFetcher:
             except requests.exceptions.RequestException as e:
                 if attempt < max_retries - 1 and (isinstance(e, requests.exceptions.HTTPError) and e.response and e.response.status_code == 503):
                     wait_time = retry_delay * (2 ** attempt)
+                    if deadline and deadline.remaining() <= wait_time:
+                        raise
                     logger.warning(f"リクエストエラー (試行 {attempt + 1}/{max_retries}): {e}。{wait_time}秒後に再試行します...")
-                    time.sleep(wait_time)
+                    if deadline:
+                        deadline.sleep(wait_time)
+                    else:
+                        time.sleep(wait_time)
                     continue
                 else:
                     # 503以外のエラー、または最大リトライ回数に達した場合は例外を再発生
@@ -132,13 +1016,23 @@ class AmazonThumbnailFetcher:
             # BeautifulSoupでHTMLを解析（より確実に商品情報を取得）
             if BS4_AVAILABLE:
                 soup = BeautifulSoup(response.text, 'html.parser')
+                raw = response.content
                 # data-component-type="s-search-result" の要素を探す
                 search_results = soup.find_all('div', {'data-component-type': 's-search-result'})
                 logger.info(f"BeautifulSoupで {len(search_results)} 件の検索結果を発見")
                 
                 # 検索結果から商品情報を抽出
                 product_data = []
-                for result in search_results[:max_results * 4]:  # 多めに取得
+                # 正規表現は生のHTMLのカード範囲に直接適用する（カード数が一致しない場合はstr(result)を使う）
+                card_spans = find_card_spans(raw)
+                if len(card_spans) != len(search_results):
+                    logger.debug(f"カード範囲の数が一致しません: {len(card_spans)} != {len(search_results)}")
+                    card_spans = [None] * len(search_results)
+                
+                for result, span in zip(search_results[:max_results * 4], card_spans):  # 多めに取得
+                    if deadline and deadline.expired():
+                        logger.warning(f"期限切れのため検索結果の解析を打ち切ります（{len(product_data)} 件）")
+                        break
                     try:
                         # ASINを取得
                         asin = result.get('data-asin')
@@ -146,57 +1040,7 @@ class AmazonThumbnailFetcher:
                             continue
                         
                         # タイトルを取得（複数の方法を試す）
-                        title = None
-                        
-                        # 方法1: h2タグ内のaタグから（すべてのspanタグのテキストを結合）
-                        h2_tag = result.find('h2')
-                        if h2_tag:
-                            a_tag = h2_tag.find('a')
-                            if a_tag:
-                                # すべてのspanタグのテキストを結合（タイトルが複数のspanに分割されている場合に対応）
-                                span_tags = a_tag.find_all('span')
-                                if span_tags:
-                                    title_parts = []
-                                    for span in span_tags:
-                                        text = span.get_text(strip=True)
-                                        if text and len(text) > 0:
-                                            title_parts.append(text)
-                                    if title_parts:
-                                        title = ' '.join(title_parts)
-                        
-                        # 方法2: h2タグ内のすべてのテキストを取得
-                        if not title and h2_tag:
-                            title = h2_tag.get_text(strip=True)
-                            # 長すぎる場合は最初の部分のみ（著者名などが含まれる場合がある）
-                            if len(title) > 200:
-                                title = title[:200]
-                        
-                        # 方法3: aタグのs-linkクラスから（すべてのspanタグのテキストを結合）
-                        if not title:
-                            a_tag = result.find('a', class_=lambda x: x and 's-link' in str(x))
-                            if a_tag:
-                                span_tags = a_tag.find_all('span')
-                                if span_tags:
-                                    title_parts = []
-                                    for span in span_tags:
-                                        text = span.get_text(strip=True)
-                                        if text and len(text) > 0:
-                                            title_parts.append(text)
-                                    if title_parts:
-                                        title = ' '.join(title_parts)
-                        
-                        # 方法4: spanタグのa-text-normalクラスから
-                        if not title:
-                            span_tags = result.find_all('span', class_=lambda x: x and 'a-text-normal' in str(x))
-                            if span_tags:
-                                title_parts = []
-                                for span in span_tags[:3]:  # 最初の3つまで
-                                    text = span.get_text(strip=True)
-                                    if text and len(text) > 3:
-                                        title_parts.append(text)
-                                if title_parts:
-                                    title = ' '.join(title_parts)
-                        
+                        title, _ = extract_card_title(result)
                         if not title or len(title) < 3:
                             continue
                         
@@ -204,49 +1048,11 @@ class AmazonThumbnailFetcher:
                         product_url = f"{self.amazon_base_url}/dp/{asin}"
                         
                         # 検索結果ページから直接画像URLを抽出
-                        thumbnail_url = None
-                        
-                        # 方法1: imgタグを探す（複数のパターンを試す）
-                        img_tag = None
-                        # パターン1: s-imageクラスを持つimgタグ
-                        img_tag = result.find('img', class_=lambda x: x and 's-image' in str(x))
-                        # パターン2: data-image-latency属性を持つimgタグ
-                        if not img_tag:
-                            img_tag = result.find('img', {'data-image-latency': True})
-                        # パターン3: 任意のimgタグ
-                        if not img_tag:
-                            img_tag = result.find('img')
-                        
-                        if img_tag:
-                            # 複数の属性から画像URLを取得（優先順位順）
-                            thumbnail_url = (
-                                img_tag.get('src') or 
-                                img_tag.get('data-src') or 
-                                img_tag.get('data-lazy-src') or 
-                                img_tag.get('data-image-src') or
-                                img_tag.get('data-old-src')
-                            )
-                        
-                        # 方法2: 正規表現で画像URLを探す（検索結果のHTMLから）
-                        if not thumbnail_url:
-                            result_html = str(result)
-                            # Amazonの画像URLパターン（より柔軟なパターン）
-                            img_patterns = [
-                                r'https://m\.media-amazon\.com/images/I/[^"\s<>]+\._AC_SL\d+_[^"\s<>]*\.(jpg|png)',
-                                r'https://m\.media-amazon\.com/images/I/[^"\s<>]+\._AC_UL\d+_[^"\s<>]*\.(jpg|png)',
-                                r'https://m\.media-amazon\.com/images/I/[^"\s<>]+\._AC_SY\d+_[^"\s<>]*\.(jpg|png)',
-                                r'https://images-na\.ssl-images-amazon\.com/images/I/[^"\s<>]+\._AC_SL\d+_[^"\s<>]*\.(jpg|png)',
-                                r'https://images-na\.ssl-images-amazon\.com/images/I/[^"\s<>]+\._SL\d+_[^"\s<>]*\.(jpg|png)',
-                            ]
-                            for pattern in img_patterns:
-                                match = re.search(pattern, result_html)
-                                if match:
-                                    thumbnail_url = match.group(0)
-                                    break
+                        thumbnail_url, _ = extract_card_thumbnail(result, raw, span)
                         
                         # 画像URLが見つからない場合は、商品ページから取得を試みる（フォールバック）
                         if not thumbnail_url:
-                            thumbnail_url = self.get_thumbnail_from_url(product_url)
+                            thumbnail_url = self.get_thumbnail_from_url(product_url, deadline)
                         
                         product_data.append({
                             'asin': asin,
@@ -309,6 +1115,9 @@ class AmazonThumbnailFetcher:
             else:
                 # 正規表現で取得した場合（後方互換性）
                 for match_info in matches[:max_results * 4]:
+                    if deadline and deadline.expired():
+                        logger.warning(f"期限切れのため検索結果の解析を打ち切ります（{len(results)} 件）")
+                        break
                     if isinstance(match_info, dict):
                         product_url = match_info.get('url')
                     else:
@@ -321,10 +1130,10 @@ class AmazonThumbnailFetcher:
                         seen_asins.add(asin)
                         
                         # 商品タイトルを取得
-                        product_title = self._extract_title_from_search_result(response.text, asin, product_url)
+                        product_title = self._extract_title_from_search_result(response.text, asin, product_url, deadline)
                         
                         # サムネイルURLを取得
-                        thumbnail_url = self.get_thumbnail_from_url(product_url)
+                        thumbnail_url = self.get_thumbnail_from_url(product_url, deadline)
                         
                         if thumbnail_url:
                             results.append({
@@ -356,7 +1165,8 @@ class AmazonThumbnailFetcher:
         
         return results
     
-    def _extract_title_from_search_result(self, html_text: str, asin: str, product_url: str) -> str:
+    def _extract_title_from_search_result(self, html_text: str, asin: str, product_url: str,
+                                          deadline: Optional[Deadline] = None) -> str:
         """検索結果ページから商品タイトルを抽出（複数のパターンを試す）"""
         # data-asin属性の周辺からタイトルを取得
         # Amazonの検索結果ページの構造に合わせて複数のパターンを試す
@@ -365,63 +1175,27 @@ class AmazonThumbnailFetcher:
         asin_pos = html_text.find(f'data-asin="{asin}"')
         if asin_pos == -1:
             # data-asinが見つからない場合、商品ページから取得
-            return self._extract_title_from_product_page(product_url)
+            return self._extract_title_from_product_page(product_url, deadline)
         
         # data-asinの周辺（前後2000文字）を抽出して検索
         context_start = max(0, asin_pos - 500)
         context_end = min(len(html_text), asin_pos + 2000)
-        context = html_text[context_start:context_end]
-        
-        patterns = [
-            # パターン1: h2タグ内のタイトル（最も一般的なパターン）
-            r'<h2[^>]*>.*?<a[^>]*>.*?<span[^>]*>([^<]+)</span>',
-            # パターン2: aタグ内のタイトル（s-linkクラス）
-            r'<a[^>]*class="[^"]*s-link[^"]*"[^>]*>.*?<span[^>]*>([^<]+)</span>',
-            # パターン3: spanタグ内のタイトル（a-text-normalクラス）
-            r'<span[^>]*class="[^"]*a-text-normal[^"]*"[^>]*>([^<]+)</span>',
-            # パターン4: より広範囲で検索（10文字以上のテキスト）
-            r'<span[^>]*>([^<]{10,150})</span>',
-        ]
-        
-        for pattern in patterns:
-            try:
-                match = re.search(pattern, context, re.DOTALL | re.IGNORECASE)
-                if match:
-                    title = match.group(1).strip()
-                    # HTMLエンティティをデコード
-                    title = title.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
-                    # 余分な空白を削除
-                    title = ' '.join(title.split())
-                    # 意味のあるタイトルかチェック（3文字以上、かつ「タイトル不明」などの無意味な文字列でない）
-                    if title and len(title) > 3 and title.lower() not in ['タイトル不明', 'title', '商品名']:
-                        # 著者名やシリーズ名が含まれている可能性があるので、長めに取得
-                        return title[:200]
-            except Exception as e:
-                logger.debug(f"タイトル抽出パターンエラー: {e}")
-                continue
+        title, _ = extract_context_title(html_text[context_start:context_end])
+        if title:
+            return title
         
         # どのパターンでも取得できなかった場合、商品ページから取得を試みる
-        return self._extract_title_from_product_page(product_url)
+        return self._extract_title_from_product_page(product_url, deadline)
     
-    def _extract_title_from_product_page(self, product_url: str) -> str:
+    def _extract_title_from_product_page(self, product_url: str, deadline: Optional[Deadline] = None) -> str:
         """商品ページからタイトルを取得"""
         try:
-            page_response = self.session.get(product_url, timeout=10)
+            page_response = self._get('product_page', product_url, 10, deadline)
             if page_response.status_code == 200:
                 # 商品ページからタイトルを取得
-                title_patterns = [
-                    r'<span[^>]*id="productTitle"[^>]*>([^<]+)</span>',
-                    r'<h1[^>]*id="title"[^>]*>.*?<span[^>]*>([^<]+)</span>',
-                    r'<meta\s+property="og:title"\s+content="([^"]+)"',
-                ]
-                for title_pattern in title_patterns:
-                    title_match = re.search(title_pattern, page_response.text, re.DOTALL | re.IGNORECASE)
-                    if title_match:
-                        title = title_match.group(1).strip()
-                        title = title.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
-                        title = ' '.join(title.split())
-                        if title and len(title) > 3:
-                            return title[:200]
+                title, _ = extract_product_title(page_response.content)
+                if title:
+                    return title
         except Exception as e:
             logger.debug(f"商品ページからのタイトル取得エラー: {e}")
         
@@ -437,43 +1211,13 @@ class AmazonThumbnailFetcher:
         3. タイトルに検索語が含まれているか
         4. 元の順番（関連性が同じ場合）
         """
-        search_lower = search_title.lower()
-        search_words = search_lower.split()
+        search_key = canonicalize_query(search_title)
+        titles = [canonicalize_query(r.get('title', '')) for r in results]
+        scores = relevance_scores(titles, search_key)
         
-        def calculate_score(candidate):
-            title_lower = candidate.get('title', '').lower()
-            score = 0
-            
-            # 完全一致（最高点）
-            if title_lower == search_lower:
-                score += 1000
-            
-            # タイトルが検索語で始まる（高得点）
-            if title_lower.startswith(search_lower):
-                score += 500
-            
-            # 検索語がタイトルに含まれる（中得点）
-            if search_lower in title_lower:
-                score += 200
-            
-            # 検索語の各単語がタイトルに含まれる（低得点）
-            for word in search_words:
-                if word in title_lower:
-                    score += 50
-            
-            # タイトルが短いほど関連性が高い可能性（微調整）
-            # ただし、タイトルが短すぎる場合はペナルティ
-            title_len = len(title_lower)
-            if 10 <= title_len <= 100:
-                score += 10
-            
-            return score
-        
-        # スコアを計算してソート
-        scored_results = [(calculate_score(r), r) for r in results]
-        scored_results.sort(key=lambda x: x[0], reverse=True)
-        
-        return [r for _, r in scored_results]
+        # スコアの高い順にソート（同点の場合は元の順番を保持）
+        scored_results = sorted(zip(scores, range(len(results))), key=lambda x: -x[0])
+        return [results[i] for _, i in scored_results]
     
     def search_amazon_by_title_single(self, title: str) -> Optional[str]:
         """タイトルでAmazonを検索して最初の結果のURLを取得（後方互換性のため）"""
@@ -482,65 +1226,116 @@ class AmazonThumbnailFetcher:
             return results[0]['url']
         return None
     
-    def get_thumbnail_url_from_asin(self, asin: str) -> str:
+    def get_thumbnail_url_from_asin(self, asin: str, deadline: Optional[Deadline] = None) -> str:
         """ASINからAmazonのサムネイル画像URLを生成"""
         # Amazonの画像URL形式: https://images-na.ssl-images-amazon.com/images/I/[IMAGE_ID]._SL[WIDTH]_.jpg
         # または: https://m.media-amazon.com/images/I/[IMAGE_ID]._SL[WIDTH]_.jpg
         
+        # 過去に解決済みのASINならカタログから返す（期限切れなら裏で更新し、古すぎれば取り直す）
+        entry = self.catalog.get(asin)
+        if entry:
+            age = time.time() - entry['fetched_at']
+            if age <= self.cache_max_stale:
+                self._on_catalog_asin_hit(asin, age > self.cache_ttl)
+                return entry['thumbnail_url']
+        
         # ASINから直接画像URLを構築することはできないため、
         # 商品ページから取得する必要がある
         product_url = f"{self.amazon_base_url}/dp/{asin}"
-        return self.get_thumbnail_from_url(product_url)
+        thumbnail_url = self.get_thumbnail_from_url(product_url, deadline)
+        if entry and thumbnail_url:
+            entry['thumbnail_url'] = thumbnail_url
+            self.catalog.add([entry])
+        return thumbnail_url
+    
+    def _on_catalog_asin_hit(self, asin: str, expired: bool):
+        """
+        カタログから返したASINのアクセス数を数え、期限切れならバックグラウンド更新を予約
+        
+        検索結果のキャッシュと同様に、アクセス数の多いASINほど先に更新します。
+        集計は最近アクセスされた asin_stats_size 件だけを保持します。
+        """
+        now = time.monotonic()
+        with self._search_cache_lock:
+            stats = self._asin_stats.get(asin)
+            if stats is None:
+                stats = self._asin_stats[asin] = {'hits': 0, 'refresh_requested_at': float('-inf')}
+            self._asin_stats.move_to_end(asin)
+            while len(self._asin_stats) > self.asin_stats_size:
+                self._asin_stats.popitem(last=False)
+            stats['hits'] += 1
+            hits = stats['hits']
+            needs_refresh = expired and now - stats['refresh_requested_at'] >= self.refresh_retry_interval
+            if needs_refresh:
+                stats['refresh_requested_at'] = now
+        
+        if needs_refresh:
+            logger.info(f"期限切れのサムネイルを返し、バックグラウンドで更新します: {asin}")
+            self.refresh_scheduler.submit(('asin', asin), hits, lambda: self._refresh_asin(asin))
+    
+    def _refresh_asin(self, asin: str):
+        """カタログのサムネイルを商品ページから取り直す（バックグラウンド実行）"""
+        entry = self.catalog.get(asin)
+        if not entry:
+            return
+        thumbnail_url = self.get_thumbnail_from_url(f"{self.amazon_base_url}/dp/{asin}",
+                                                    Deadline(self.refresh_deadline_seconds, PRIORITY_REFRESH))
+        if thumbnail_url:
+            entry['thumbnail_url'] = thumbnail_url
+            self.catalog.add([entry])
+            with self._search_cache_lock:
+                stats = self._asin_stats.get(asin)
+                if stats is not None:
+                    stats['refresh_requested_at'] = float('-inf')
+            logger.info(f"サムネイルを更新しました: {asin}")
+        else:
+            # 取得に失敗した場合は古い画像URLを残し、refresh_retry_interval後に再試行する
+            logger.warning(f"サムネイルの更新に失敗しました: {asin}")
     
-    def get_thumbnail_from_url(self, url: str) -> Optional[str]:
+    def get_thumbnail_from_url(self, url: str, deadline: Optional[Deadline] = None) -> Optional[str]:
         """Amazon商品URLからサムネイル画像URLを取得"""
         try:
-            response = self.session.get(url, timeout=30)
+            response = self._get('product_page', url, 30, deadline)
             response.raise_for_status()
             
-            # 画像URLのパターンを探す
-            # パターン1: images-na.ssl-images-amazon.com
-            pattern1 = r'https://images-na\.ssl-images-amazon\.com/images/I/[^"\s]+\._SL\d+_\.jpg'
-            # パターン2: m.media-amazon.com
-            pattern2 = r'https://m\.media-amazon\.com/images/I/[^"\s]+\._SL\d+_\.jpg'
-            # パターン3: メタタグから取得
-            pattern3 = r'<meta\s+property="og:image"\s+content="([^"]+)"'
-            
-            # メタタグから取得を試みる（最も確実）
-            meta_match = re.search(pattern3, response.text)
-            if meta_match:
-                return meta_match.group(1)
-            
-            # 直接パターンマッチを試みる
-            for pattern in [pattern1, pattern2]:
-                matches = re.findall(pattern, response.text)
-                if matches:
-                    # 最初のマッチを返す（通常はメイン画像）
-                    return matches[0]
+            # メタタグ、画像URLパターンの順に探す
+            thumbnail_url, _ = extract_product_thumbnail(response.content)
+            if thumbnail_url:
+                return thumbnail_url
             
             logger.warning(f"画像URLが見つかりませんでした: {url}")
             
+        except DeadlineExceeded:
+            logger.warning(f"期限切れのため画像URLの取得を中止しました: {url}")
         except Exception as e:
             logger.error(f"画像URL取得エラー: {e}")
         
         return None
     
-    def get_thumbnail_by_title(self, title: str) -> Optional[str]:
+    def get_thumbnail_by_title(self, title: str, deadline: Optional[Deadline] = None) -> Optional[str]:
         """タイトルからサムネイル画像URLを取得（最初の1件のみ）"""
-        results = self.search_amazon_by_title(title, max_results=1)
+        results = self.search_amazon_by_title(title, max_results=1, deadline=deadline)
         if results:
             return results[0]['thumbnail_url']
         return None
     
-    def get_thumbnails_by_title(self, title: str, max_results: int = 5) -> List[Dict[str, str]]:
+    def get_thumbnails_by_title(self, title: str, max_results: int = 5,
+                                deadline: Optional[Deadline] = None) -> List[Dict[str, str]]:
         """タイトルから複数のサムネイル画像候補を取得"""
         logger.info(f"タイトルで検索（複数候補）: {title}")
-        return self.search_amazon_by_title(title, max_results=max_results)
+        return self.search_amazon_by_title(title, max_results=max_results, deadline=deadline)
     
-    def get_thumbnail_by_isbn(self, isbn: str) -> Optional[str]:
-        """ISBNからサムネイル画像URLを取得"""
+    def register_cover_provider(self, provider: CoverProvider):
+        """ISBNで表紙画像を引くプロバイダーを追加登録"""
+        self.cover_resolver.register(provider)
+    
+    def get_thumbnail_by_isbn(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        """ISBNからサムネイル画像URLを取得（登録済みのプロバイダーにヘッジして問い合わせ）"""
         logger.info(f"ISBNで検索: {isbn}")
-        
+        return self.cover_resolver.resolve(isbn, deadline)
+    
+    def _get_thumbnail_by_isbn_from_amazon(self, isbn: str, deadline: Optional[Deadline] = None) -> Optional[str]:
+        """ISBNからAmazonの商品ページ経由でサムネイル画像URLを取得"""
         # ISBNからASINを取得
         asin = self.isbn_to_asin(isbn)
         if not asin:
@@ -550,11 +1345,11 @@ class AmazonThumbnailFetcher:
         logger.info(f"ASIN: {asin}")
         
         # ASINから画像URLを取得
-        thumbnail_url = self.get_thumbnail_url_from_asin(asin)
+        thumbnail_url = self.get_thumbnail_url_from_asin(asin, deadline)
         return thumbnail_url
     
     def get_thumbnail(self, title: Optional[str] = None, isbn: Optional[str] = None, 
-                     amazon_url: Optional[str] = None) -> Optional[str]:
+                     amazon_url: Optional[str] = None, deadline: Optional[Deadline] = None) -> Optional[str]:
         """
         本の情報からAmazonサムネイル画像URLを取得
         
@@ -562,6 +1357,7 @@ class AmazonThumbnailFetcher:
             title: 本のタイトル
             isbn: ISBN（10桁または13桁）
             amazon_url: Amazon商品ページのURL
+            deadline: リクエスト全体の期限（各上流呼び出しは残り時間だけを使う）
         
         Returns:
             サムネイル画像のURL、取得できない場合はNone
@@ -570,17 +1366,17 @@ class AmazonThumbnailFetcher:
         if amazon_url:
             asin = self.extract_asin_from_url(amazon_url)
             if asin:
-                return self.get_thumbnail_url_from_asin(asin)
+                return self.get_thumbnail_url_from_asin(asin, deadline)
             else:
-                return self.get_thumbnail_from_url(amazon_url)
+                return self.get_thumbnail_from_url(amazon_url, deadline)
         
         if isbn:
-            result = self.get_thumbnail_by_isbn(isbn)
+            result = self.get_thumbnail_by_isbn(isbn, deadline)
             if result:
                 return result
         
         if title:
-            return self.get_thumbnail_by_title(title)
+            return self.get_thumbnail_by_title(title, deadline)
         
         logger.warning("タイトル、ISBN、URLのいずれも指定されていません")
         return None
@@ -7,17 +7,18 @@ Notionウィジェット用のバックエンドAPI
 
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
+import math
 import sys
 import os
 
 # amazon_thumbnail_fetcherをインポート（同じディレクトリまたは親ディレクトリから）
 try:
     # 同じディレクトリからインポートを試みる
-    from amazon_thumbnail_fetcher import AmazonThumbnailFetcher
+    from amazon_thumbnail_fetcher import AmazonThumbnailFetcher, Deadline, DeadlineExceeded, PRIORITY_INTERACTIVE
 except ImportError:
     # 親ディレクトリからインポートを試みる
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from amazon_thumbnail_fetcher import AmazonThumbnailFetcher
+    from amazon_thumbnail_fetcher import AmazonThumbnailFetcher, Deadline, DeadlineExceeded, PRIORITY_INTERACTIVE
 
 app = Flask(__name__, static_folder='.', static_url_path='')
 CORS(app)  # CORSを有効化（Notionウィジェットからアクセス可能にする）
@@ -25,6 +26,31 @@ CORS(app)  # CORSを有効化（Notionウィジェットからアクセス可能
 # Amazonサムネイル取得クラスのインスタンス
 thumbnail_fetcher = AmazonThumbnailFetcher()
 
+# リクエストの期限（秒）。クライアントが timeout_ms を指定しない場合はデフォルト値を使う
+# MAX_DEADLINE_SECONDS は gunicorn の --timeout（Procfile・render.yaml で130秒）より短くしておくこと
+# （先にワーカーが強制終了されると、504ではなく502になる）
+DEFAULT_DEADLINE_SECONDS = float(os.environ.get('DEFAULT_DEADLINE_SECONDS', 50))
+MAX_DEADLINE_SECONDS = float(os.environ.get('MAX_DEADLINE_SECONDS', 120))
+
+
+def _request_deadline(data) -> Deadline:
+    """リクエストボディの timeout_ms（ミリ秒）と priority から期限を作成"""
+    seconds = DEFAULT_DEADLINE_SECONDS
+    timeout_ms = data.get('timeout_ms')
+    if timeout_ms is not None:
+        try:
+            seconds = float(timeout_ms) / 1000
+        except (TypeError, ValueError):
+            pass
+        # NaN・無限大は上限の切り詰めをすり抜けるので使わない
+        if not math.isfinite(seconds):
+            seconds = DEFAULT_DEADLINE_SECONDS
+    # 一括インポートなどは priority: "bulk" を指定する（省略時はウィジェットからの対話的な検索）
+    priority = data.get('priority')
+    if not isinstance(priority, str) or priority not in thumbnail_fetcher.upstream_scheduler.classes:
+        priority = PRIORITY_INTERACTIVE
+    return Deadline(min(max(seconds, 1.0), MAX_DEADLINE_SECONDS), priority)
+
 
 @app.route('/api/get-thumbnail', methods=['POST'])
 def get_thumbnail():
@@ -32,6 +58,7 @@ def get_thumbnail():
     try:
         data = request.get_json()
         print(f"受信したリクエスト: {data}")
+        deadline = _request_deadline(data)
         
         title = data.get('title')
         isbn = data.get('isbn')
@@ -48,7 +75,8 @@ def get_thumbnail():
             # ISBNの場合は1件のみ
             thumbnail_url = thumbnail_fetcher.get_thumbnail(
                 title=None,
-                isbn=isbn
+                isbn=isbn,
+                deadline=deadline
             )
             if thumbnail_url:
                 result = {
@@ -69,7 +97,7 @@ def get_thumbnail():
         else:
             print(f"タイトルで検索: {title}, max_results: {max_results}")
             # タイトルの場合は複数候補を返す
-            candidates = thumbnail_fetcher.get_thumbnails_by_title(title, max_results=max_results)
+            candidates = thumbnail_fetcher.get_thumbnails_by_title(title, max_results=max_results, deadline=deadline)
             print(f"タイトル検索結果: {len(candidates)}件見つかりました")
             
             if candidates:
@@ -85,6 +113,11 @@ def get_thumbnail():
                     'error': 'サムネイル画像が見つかりませんでした。Amazonサーバーが一時的に利用できない可能性があります。しばらく待ってから再試行してください。'
                 }), 404
             
+    except DeadlineExceeded:
+        print(f"期限切れ: 上流への問い合わせを打ち切りました")
+        return jsonify({
+            'error': 'タイムアウトしました。しばらく待ってから再試行してください。'
+        }), 504
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
@@ -100,6 +133,15 @@ def health():
     """ヘルスチェックエンドポイント"""
     return jsonify({'status': 'ok'})
 
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """上流スケジューラーの優先度クラスごとの待ち行列・待ち時間とバックグラウンド更新の状況"""
+    return jsonify({
+        'upstream': thumbnail_fetcher.upstream_scheduler.stats(),
+        'refresh': thumbnail_fetcher.refresh_scheduler.stats(),
+    })
+
 @app.route('/')
 def index():
     """フロントエンドのHTMLを返す"""
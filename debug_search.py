@@ -3,12 +3,56 @@
 """
 Amazon検索結果のデバッグ用スクリプト
 実際のHTML構造を確認して、タイトル取得方法を改善する
+
+使い方:
+    python debug_search.py "タイトル"              # 実際の検索結果のHTML構造を表示
+    python debug_search.py --profile fixtures/html  # 保存したHTMLで抽出戦略をプロファイル
+        [--cprofile out.prof] [--flamegraph out.folded] [--repeat N]
+    python debug_search.py --benchmark fixtures/html  # コンパイル済みの抽出エンジンと従来の抽出を比較
+    python debug_search.py --hedge-check            # ローカルのスタブサーバーでヘッジと打ち切りを確認
 """
 
+import argparse
+import cProfile
+import glob
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import requests
 import re
 from bs4 import BeautifulSoup
 
+from amazon_thumbnail_fetcher import (
+    AmazonCoverProvider,
+    AmazonThumbnailFetcher,
+    CoverResolver,
+    Deadline,
+    OpenBDCoverProvider,
+    UpstreamScheduler,
+    CARD_IMAGE_ATTRIBUTES,
+    CARD_IMAGE_PATTERNS,
+    CARD_IMAGE_ENGINE,
+    CARD_IMAGE_TAG_STRATEGIES,
+    CARD_TITLE_STRATEGIES,
+    PRODUCT_IMAGE_ENGINE,
+    PRODUCT_IMAGE_PATTERNS,
+    PRODUCT_TITLE_ENGINE,
+    PRODUCT_TITLE_PATTERNS,
+    SEARCH_CONTEXT_TITLE_PATTERNS,
+    extract_card_thumbnail,
+    extract_card_title,
+    extract_context_title,
+    extract_product_thumbnail,
+    extract_product_title,
+)
+from extraction_engine import decode, find_card_spans
+
 def debug_amazon_search(title: str):
     """Amazon検索結果のHTML構造をデバッグ"""
     amazon_base_url = "https://www.amazon.co.jp"
@@ -90,8 +134,448 @@ def debug_amazon_search(title: str):
     print("=" * 60)
 
 
+class StrategyStats:
+    """抽出戦略ごとの集計（reached: 本番の順序でこの戦略まで到達した数、won: 採用された数）"""
+    
+    def __init__(self, names):
+        self.names = list(names)
+        self.reached = defaultdict(int)
+        self.won = defaultdict(int)
+        self.hits = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.samples = 0
+    
+    def measure(self, name, func, *args):
+        """戦略を単独で実行して、ヒットしたかと所要時間を記録"""
+        start = time.perf_counter()
+        value = func(*args)
+        self.seconds[name] += time.perf_counter() - start
+        if value:
+            self.hits[name] += 1
+        return value
+    
+    def record_winner(self, winner, skipped=()):
+        """本番の順序で試した場合に、どこまで到達してどれが採用されたかを記録（skippedは本番で試されない戦略）"""
+        self.samples += 1
+        for name in self.names:
+            if name in skipped:
+                continue
+            self.reached[name] += 1
+            if name == winner:
+                self.won[name] += 1
+                break
+    
+    def report(self, heading):
+        print(f"\n{heading}（{self.samples}件）")
+        print(f"  {'戦略':<26}{'到達':>6}{'採用':>6}{'単独ヒット率':>12}{'平均時間(µs)':>14}")
+        for name in self.names:
+            hit_rate = self.hits[name] / self.samples if self.samples else 0.0
+            avg_us = self.seconds[name] / self.samples * 1e6 if self.samples else 0.0
+            mark = "  ← 採用なし" if self.reached[name] and not self.won[name] else ""
+            print(f"  {name:<26}{self.reached[name]:>6}{self.won[name]:>6}{hit_rate:>12.1%}{avg_us:>14.1f}{mark}")
+
+
+def _img_url(find_img, result):
+    """imgタグの探し方を単独で評価（タグが見つかり、属性からURLが取れればヒット）"""
+    img_tag = find_img(result)
+    if not img_tag:
+        return None
+    for attribute in CARD_IMAGE_ATTRIBUTES:
+        if img_tag.get(attribute):
+            return img_tag.get(attribute)
+    return None
+
+
+def load_corpus(corpus_dir: str):
+    """保存したHTMLを検索結果ページと商品ページに振り分けて読み込む。各要素は (パス, 生のバイト列, 文字列)"""
+    search_pages, product_pages = [], []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '**', '*.html'), recursive=True)):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        html_text = raw.decode('utf-8', errors='replace')
+        if b'data-component-type="s-search-result"' in raw:
+            search_pages.append((path, raw, html_text))
+        else:
+            product_pages.append((path, raw, html_text))
+    return search_pages, product_pages
+
+
+def profile_extraction(corpus_dir: str, repeat: int = 1):
+    """
+    保存したHTMLに対してフェッチャーの抽出戦略を実行し、戦略ごとのヒット率とコストを表示
+
+    正規表現の戦略は本番と同じく、抽出エンジンのコンパイル済みパターンを生のバイト列
+    （検索結果はカードのバイト範囲）に適用して計測します。
+    """
+    search_pages, product_pages = load_corpus(corpus_dir)
+    print(f"コーパス: {corpus_dir}（検索結果ページ {len(search_pages)} 件、商品ページ {len(product_pages)} 件）")
+    
+    title_stats = StrategyStats(name for name, _ in CARD_TITLE_STRATEGIES)
+    img_tag_names = [name for name, _ in CARD_IMAGE_TAG_STRATEGIES]
+    image_stats = StrategyStats(img_tag_names + [name for name, _ in CARD_IMAGE_PATTERNS])
+    product_image_stats = StrategyStats(name for name, _ in PRODUCT_IMAGE_PATTERNS)
+    product_title_stats = StrategyStats(name for name, _ in PRODUCT_TITLE_PATTERNS)
+    
+    cards = 0
+    fallbacks = 0
+    parse_seconds = 0.0
+    card_seconds = 0.0
+    # カード範囲の数がBeautifulSoupと一致せず、str(result) に適用した（従来の経路の）カード数
+    legacy_cards = 0
+    
+    for _ in range(repeat):
+        for path, raw, html_text in search_pages:
+            start = time.perf_counter()
+            soup = BeautifulSoup(html_text, 'html.parser')
+            results = soup.find_all('div', {'data-component-type': 's-search-result'})
+            spans = find_card_spans(raw)
+            parse_seconds += time.perf_counter() - start
+            if len(spans) != len(results):
+                spans = [None] * len(results)
+            
+            for result, span in zip(results, spans):
+                if not result.get('data-asin'):
+                    continue
+                cards += 1
+                
+                # 本番と同じ順序での抽出（カード1件あたりの時間）
+                start = time.perf_counter()
+                _, title_winner = extract_card_title(result)
+                thumbnail_url, image_winner = extract_card_thumbnail(result, raw, span)
+                card_seconds += time.perf_counter() - start
+                if not thumbnail_url:
+                    # 本番では商品ページの取得（get_thumbnail_from_url）にフォールバックする
+                    fallbacks += 1
+                
+                # 各戦略を単独で実行
+                for name, strategy in CARD_TITLE_STRATEGIES:
+                    title_stats.measure(name, strategy, result)
+                title_stats.record_winner(title_winner)
+                
+                # 本番では最初に見つかったimgタグだけを使うので、それより後の探し方は試されない
+                found = next((i for i, (_, find_img) in enumerate(CARD_IMAGE_TAG_STRATEGIES) if find_img(result)), None)
+                skipped = set(img_tag_names[found + 1:]) if found is not None else set()
+                for name, find_img in CARD_IMAGE_TAG_STRATEGIES:
+                    image_stats.measure(name, _img_url, find_img, result)
+                if span is not None:
+                    for name, regex in CARD_IMAGE_ENGINE.strategies(bytes):
+                        image_stats.measure(name, regex.search, raw, *span)
+                else:
+                    legacy_cards += 1
+                    result_html = str(result)
+                    for name, regex in CARD_IMAGE_ENGINE.strategies(str):
+                        image_stats.measure(name, regex.search, result_html)
+                image_stats.record_winner(image_winner, skipped)
+        
+        for path, raw, html_text in product_pages:
+            _, image_winner = extract_product_thumbnail(raw)
+            _, title_winner = extract_product_title(raw)
+            for name, regex in PRODUCT_IMAGE_ENGINE.strategies(bytes):
+                product_image_stats.measure(name, regex.search, raw)
+            product_image_stats.record_winner(image_winner)
+            for name, regex in PRODUCT_TITLE_ENGINE.strategies(bytes):
+                product_title_stats.measure(name, regex.search, raw)
+            product_title_stats.record_winner(title_winner)
+    
+    print("\n" + "=" * 60)
+    print("検索結果カード")
+    print("=" * 60)
+    if cards:
+        print(f"カード数: {cards}")
+        print(f"HTML解析（ページ全体）: {parse_seconds / cards * 1e6:.1f} µs/カード")
+        print(f"抽出（本番の順序）: {card_seconds / cards * 1e6:.1f} µs/カード")
+        if legacy_cards:
+            print(f"カード範囲が取れず str(result) に適用（従来の経路）: {legacy_cards}件")
+        print(f"商品ページへのフォールバック率: {fallbacks / cards:.1%}（{fallbacks}件）")
+    title_stats.report("タイトル抽出")
+    image_stats.report("画像URL抽出（imgタグ → 正規表現、カードのバイト範囲に適用）")
+    
+    print("\n" + "=" * 60)
+    print("商品ページ")
+    print("=" * 60)
+    product_image_stats.report("画像URL抽出（生のバイト列に適用）")
+    product_title_stats.report("タイトル抽出（生のバイト列に適用）")
+
+
+def _legacy_card_image(result):
+    """従来の方法: カードを再シリアライズして、パターンを1つずつ適用"""
+    result_html = str(result)
+    for _, pattern in CARD_IMAGE_PATTERNS:
+        match = re.search(pattern, result_html)
+        if match:
+            return match.group(0)
+    return None
+
+
+def _legacy_product_image(html_text):
+    """従来の方法: og:image を探してから、残りのパターンを findall で1つずつ適用"""
+    meta_match = re.search(PRODUCT_IMAGE_PATTERNS[0][1], html_text)
+    if meta_match:
+        return meta_match.group(1)
+    for _, pattern in PRODUCT_IMAGE_PATTERNS[1:]:
+        matches = re.findall(pattern, html_text)
+        if matches:
+            return matches[0]
+    return None
+
+
+def _legacy_title(patterns, html_text, stop_words=()):
+    """従来の方法: DOTALLのパターンを1つずつ適用し、意味のあるタイトルが取れたものを返す"""
+    for _, pattern in patterns:
+        match = re.search(pattern, html_text, re.DOTALL | re.IGNORECASE)
+        if match:
+            title = match.group(1).strip()
+            title = title.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
+            title = ' '.join(title.split())
+            if title and len(title) > 3 and title.lower() not in stop_words:
+                return title[:200]
+    return None
+
+
+def benchmark_extraction(corpus_dir: str, repeat: int = 100):
+    """保存したHTMLに対して、コンパイル済みの抽出エンジンと従来の抽出の結果と速度を比較"""
+    search_pages, product_pages = load_corpus(corpus_dir)
+    print(f"コーパス: {corpus_dir}（検索結果ページ {len(search_pages)} 件、商品ページ {len(product_pages)} 件、{repeat}回繰り返し）")
+    
+    # (名前, 従来の方法, エンジン) の組を作る
+    cases = []
+    for path, raw, html_text in search_pages:
+        soup = BeautifulSoup(html_text, 'html.parser')
+        results = soup.find_all('div', {'data-component-type': 's-search-result'})
+        spans = find_card_spans(raw)
+        if len(spans) != len(results):
+            print(f"  警告: カード範囲の数が一致しません（{path}）")
+            continue
+        for result, span in zip(results, spans):
+            asin = result.get('data-asin')
+            if not asin:
+                continue
+            cases.append(('カード画像URL', path,
+                          lambda r=result: _legacy_card_image(r),
+                          lambda s=span, b=raw: decode(CARD_IMAGE_ENGINE.search(b, *s)[0])))
+            asin_pos = html_text.find(f'data-asin="{asin}"')
+            context = html_text[max(0, asin_pos - 500):asin_pos + 2000]
+            cases.append(('data-asin周辺のタイトル', path,
+                          lambda c=context: _legacy_title(SEARCH_CONTEXT_TITLE_PATTERNS, c,
+                                                          ['タイトル不明', 'title', '商品名']),
+                          lambda c=context: extract_context_title(c)[0]))
+    for path, raw, html_text in product_pages:
+        cases.append(('商品ページ画像URL', path,
+                      lambda t=html_text: _legacy_product_image(t),
+                      lambda b=raw: extract_product_thumbnail(b)[0]))
+        cases.append(('商品ページタイトル', path,
+                      lambda t=html_text: _legacy_title(PRODUCT_TITLE_PATTERNS, t),
+                      lambda b=raw: extract_product_title(b)[0]))
+    
+    legacy_seconds = defaultdict(float)
+    engine_seconds = defaultdict(float)
+    counts = defaultdict(int)
+    mismatches = 0
+    for kind, path, legacy, engine in cases:
+        expected, actual = legacy(), engine()
+        if expected != actual:
+            mismatches += 1
+            print(f"  不一致 [{kind}] {path}: 従来={expected!r} エンジン={actual!r}")
+        counts[kind] += 1
+        start = time.perf_counter()
+        for _ in range(repeat):
+            legacy()
+        legacy_seconds[kind] += time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            engine()
+        engine_seconds[kind] += time.perf_counter() - start
+    
+    print(f"\n結果の不一致: {mismatches} / {len(cases)}")
+    print(f"\n  {'対象':<20}{'件数':>6}{'従来(µs)':>12}{'エンジン(µs)':>14}{'速度比':>8}")
+    for kind in counts:
+        legacy_us = legacy_seconds[kind] / (counts[kind] * repeat) * 1e6
+        engine_us = engine_seconds[kind] / (counts[kind] * repeat) * 1e6
+        print(f"  {kind:<20}{counts[kind]:>6}{legacy_us:>12.1f}{engine_us:>14.1f}{legacy_us / engine_us:>7.1f}x")
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    ヘッジ確認用のスタブ
+    /dp/<ASIN>: 商品ページ（0.1秒ごとに1バイトずつ、いつまでも終わらない）
+    /v1/get: openBDの応答（すぐに表紙画像URLを返す）
+    """
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_GET(self):
+        if self.path.startswith('/dp/'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', '100000')
+            self.end_headers()
+            try:
+                for _ in range(100000):
+                    self.wfile.write(b' ')
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except OSError:
+                # クライアントが打ち切った
+                self.server.aborted += 1
+        else:
+            body = json.dumps([{'summary': {'cover': 'https://cover.openbd.jp/stub.jpg'}}]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+def _wait_until(condition, timeout: float) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def check_hedging() -> bool:
+    """
+    ローカルのスタブサーバーに対して、ISBNのヘッジと負けた問い合わせの打ち切りを確認
+
+    1. Amazon（遅い）にヘッジ遅延内の応答がなく、openBDの結果が返ること
+    2. 負けたAmazonの問い合わせが、本文の受信中に打ち切られて実行枠を返すこと
+    3. 実行枠を待っている間に負けた問い合わせが、すぐに待ち行列から外れること
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.aborted = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    catalog_dir = tempfile.mkdtemp()
+    ok = True
+    
+    def report(passed: bool, message: str):
+        nonlocal ok
+        ok = ok and passed
+        print(f"{'✓' if passed else '✗'} {message}")
+    
+    try:
+        fetcher = AmazonThumbnailFetcher(catalog_path=os.path.join(catalog_dir, 'catalog.json'))
+        fetcher.amazon_base_url = base_url
+        fetcher.cover_resolver = CoverResolver(
+            [AmazonCoverProvider(fetcher), OpenBDCoverProvider(base_url)], default_hedge_delay=0.3
+        )
+        scheduler = fetcher.upstream_scheduler
+        
+        # 1, 2: 本文の受信中の打ち切り
+        start = time.monotonic()
+        cover = fetcher.get_thumbnail_by_isbn('4873115655', Deadline(10))
+        elapsed = time.monotonic() - start
+        report(cover == 'https://cover.openbd.jp/stub.jpg' and elapsed < 1.0,
+               f"ヘッジしてopenBDの結果を返す: {cover}（{elapsed:.2f}秒）")
+        released = _wait_until(lambda: scheduler.stats()['interactive']['running'] == 0, 1.0)
+        report(released, "負けたAmazonの問い合わせが実行枠を返す")
+        report(_wait_until(lambda: server.aborted >= 1, 1.0), "負けたAmazonの接続が閉じられる")
+        
+        # 3: 実行枠を待っている間の打ち切り（枠を1つにして、別のリクエストに握らせておく）
+        fetcher.upstream_scheduler = scheduler = UpstreamScheduler(max_concurrency=1)
+        holding = threading.Event()
+        release = threading.Event()
+        
+        def hold_slot():
+            with scheduler.slot('interactive'):
+                holding.set()
+                release.wait(10)
+        
+        threading.Thread(target=hold_slot, daemon=True).start()
+        holding.wait(1)
+        cover = fetcher.get_thumbnail_by_isbn('4873115655', Deadline(10))
+        left = _wait_until(lambda: scheduler.stats()['interactive']['queued'] == 0, 0.5)
+        report(cover is not None and left, "実行枠を待っていた負けた問い合わせが、すぐに待ち行列から外れる")
+        release.set()
+    finally:
+        server.shutdown()
+    
+    print(f"\n{'すべて成功しました' if ok else '失敗した確認があります'}")
+    return ok
+
+
+class FlameGraphCollector:
+    """
+    sys.setprofile で関数呼び出しのスタックごとの時間を集計し、
+    flamegraph.pl や speedscope で読める collapsed stack 形式で書き出す
+    """
+    
+    def __init__(self):
+        self._stack = []
+        self._inclusive = defaultdict(float)
+    
+    def _profile(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == 'call':
+            code = frame.f_code
+            self._stack.append((f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})", now))
+        elif event == 'c_call':
+            self._stack.append((getattr(arg, '__qualname__', repr(arg)), now))
+        elif event in ('return', 'c_return', 'c_exception') and self._stack:
+            path = tuple(name for name, _ in self._stack)
+            _, start = self._stack.pop()
+            self._inclusive[path] += now - start
+    
+    def __enter__(self):
+        sys.setprofile(self._profile)
+        return self
+    
+    def __exit__(self, *exc):
+        sys.setprofile(None)
+    
+    def write(self, path: str):
+        # 自身の時間 = そのスタックの時間 - 直下の呼び出しの時間
+        self_time = dict(self._inclusive)
+        for stack, seconds in self._inclusive.items():
+            if len(stack) > 1 and stack[:-1] in self_time:
+                self_time[stack[:-1]] -= seconds
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, seconds in sorted(self_time.items()):
+                microseconds = int(seconds * 1e6)
+                if microseconds > 0:
+                    f.write(f"{';'.join(stack)} {microseconds}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Amazon検索結果のデバッグ・抽出戦略のプロファイル")
+    parser.add_argument('title', nargs='?', default="いけない", help="実際に検索するタイトル")
+    parser.add_argument('--profile', metavar='DIR', help="保存した検索結果・商品ページのHTMLがあるディレクトリ")
+    parser.add_argument('--benchmark', metavar='DIR', help="抽出エンジンと従来の逐次適用を比較するHTMLのディレクトリ")
+    parser.add_argument('--hedge-check', action='store_true', help="ローカルのスタブサーバーでISBNのヘッジと打ち切りを確認")
+    parser.add_argument('--repeat', type=int, default=None, help="コーパスを繰り返す回数（計測を安定させる）")
+    parser.add_argument('--cprofile', metavar='PATH', help="cProfileの結果（pstats形式）の出力先")
+    parser.add_argument('--flamegraph', metavar='PATH', help="collapsed stack 形式の出力先")
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        benchmark_extraction(args.benchmark, args.repeat or 100)
+        return
+    
+    if args.hedge_check:
+        sys.exit(0 if check_hedging() else 1)
+    
+    if not args.profile:
+        debug_amazon_search(args.title)
+        return
+    
+    repeat = args.repeat or 1
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.runcall(profile_extraction, args.profile, repeat)
+        profiler.dump_stats(args.cprofile)
+        print(f"\ncProfileの結果を書き出しました: {args.cprofile}")
+    elif args.flamegraph:
+        with FlameGraphCollector() as collector:
+            profile_extraction(args.profile, repeat)
+        collector.write(args.flamegraph)
+        print(f"\nフレームグラフ用のスタックを書き出しました: {args.flamegraph}")
+    else:
+        profile_extraction(args.profile, repeat)
+
+
 if __name__ == "__main__":
-    import sys
-    search_title = sys.argv[1] if len(sys.argv) > 1 else "いけない"
-    debug_amazon_search(search_title)
+    main()
 
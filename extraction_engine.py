@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+コンパイル済みの抽出エンジン
+優先順位付きの正規表現をインポート時にコンパイルしておき、最も優先度の高いマッチを返します。
+生のバイト列（レスポンスのcontent）の指定範囲にそのまま適用できるので、
+BeautifulSoupのツリーを再シリアライズ（str(result)）する必要がありません。
+"""
+
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+Text = Union[str, bytes]
+
+# 検索結果カードの開始タグと、divの開始・終了タグ
+_CARD_START = re.compile(rb'<div\b[^>]*\bdata-component-type="s-search-result"', re.IGNORECASE)
+_DIV_TAG = re.compile(rb'<(/?)div\b[^>]*>', re.IGNORECASE)
+
+
+class PriorityPattern:
+    """
+    優先順位付きの正規表現の集合
+
+    search() は、個々のパターンを優先順位順に re.search して最初に
+    （validateを通る）マッチが得られたものを返します。パターンはインポート時に
+    str用・bytes用の両方をコンパイルしておき、呼び出しごとのコンパイルやキャッシュ参照をなくします。
+
+    全パターンを1つの選択肢（a|b|c）にまとめる方式も試しましたが、reは選択肢になると
+    先頭の固定文字列による高速なスキャンが効かなくなり、実測で数倍遅くなったため採用していません。
+    """
+
+    def __init__(self, alternatives: Sequence[Tuple[str, str]], flags: int = 0, first_group: bool = False):
+        """
+        Args:
+            alternatives: (名前, パターン) のリスト（優先順位順）
+            flags: reのフラグ
+            first_group: Trueの場合、キャプチャグループを持つパターンは最初のグループを値とする
+                         （持たないパターンとFalseの場合はマッチ全体）
+        """
+        self.names = [name for name, _ in alternatives]
+        self._compiled: Dict[type, List[Tuple[re.Pattern, int]]] = {}
+
+        for kind in (str, bytes):
+            compiled = []
+            for _, pattern in alternatives:
+                regex = re.compile(pattern.encode('utf-8') if kind is bytes else pattern, flags)
+                compiled.append((regex, 1 if first_group and regex.groups else 0))
+            self._compiled[kind] = compiled
+
+    def strategies(self, kind: type = bytes) -> List[Tuple[str, re.Pattern]]:
+        """コンパイル済みの (パターン名, 正規表現) を優先順位順に返す（プロファイル用）"""
+        return [(name, regex) for name, (regex, _) in zip(self.names, self._compiled[kind])]
+
+    def search(self, data: Text, start: int = 0, end: Optional[int] = None,
+               validate: Optional[Callable[[Text], bool]] = None) -> Tuple[Optional[Text], Optional[str]]:
+        """
+        data[start:end] から最も優先度の高いマッチを探す。(値, パターン名)
+
+        各パターンは最初のマッチだけを見て、validateがFalseを返した場合は次のパターンへ進みます。
+        """
+        if end is None:
+            end = len(data)
+        for name, (regex, group) in zip(self.names, self._compiled[type(data)]):
+            match = regex.search(data, start, end)
+            if not match:
+                continue
+            value = match.group(group)
+            if validate is None or validate(value):
+                return value, name
+        return None, None
+
+
+def decode(value: Optional[Text]) -> Optional[str]:
+    """バイト列の値をUTF-8として文字列に変換"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
+
+
+def find_card_spans(data: bytes) -> List[Tuple[int, int]]:
+    """
+    生のHTMLから検索結果カード（data-component-type="s-search-result" のdiv）の
+    バイト範囲を出現順に返す（divの入れ子を数えて終了タグを探す）
+    """
+    spans = []
+    for card in _CARD_START.finditer(data):
+        depth = 0
+        for tag in _DIV_TAG.finditer(data, card.start()):
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                spans.append((card.start(), tag.end()))
+                break
+        else:
+            spans.append((card.start(), len(data)))
+    return spans
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+解決済みの本のローカルカタログ
+一度Amazonから取得した候補（タイトル・ASIN・サムネイル）を取得日時とともに保存し、
+文字n-gramの転置インデックスで検索できるようにします。
+検索語（正規形）ごとに解決した候補の並びも保存し、同じ検索はそのまま再現します。
+"""
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from query_canonicalizer import canonicalize_query
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    logging.warning("numpyがインストールされていません。カタログのスコア計算が簡易版になります。")
+
+logger = logging.getLogger(__name__)
+
+_NUMBER_PATTERN = re.compile(r'\d+')
+
+
+def char_ngrams(text: str, n: int = 2) -> List[str]:
+    """文字n-gramを生成（空白は無視。n文字未満の場合はそのまま1つのgramとする）"""
+    compact = text.replace(' ', '')
+    if len(compact) < n:
+        return [compact] if compact else []
+    return [compact[i:i + n] for i in range(len(compact) - n + 1)]
+
+
+def relevance_scores(titles: Sequence[str], query: str) -> List[int]:
+    """
+    検索語との関連性スコアを一括計算
+
+    スコア基準:
+    1. 完全一致: +1000
+    2. タイトルが検索語で始まる: +500
+    3. 検索語がタイトルに含まれる: +200
+    4. 検索語の各単語がタイトルに含まれる: 各+50
+    5. タイトルが10〜100文字: +10
+    """
+    if not titles:
+        return []
+    words = query.split()
+
+    if NUMPY_AVAILABLE:
+        arr = np.array(titles, dtype=str)
+        scores = np.zeros(len(arr), dtype=np.int64)
+        scores += (arr == query) * 1000
+        scores += np.char.startswith(arr, query) * 500
+        scores += (np.char.find(arr, query) >= 0) * 200
+        for word in words:
+            scores += (np.char.find(arr, word) >= 0) * 50
+        lengths = np.char.str_len(arr)
+        scores += ((lengths >= 10) & (lengths <= 100)) * 10
+        return scores.tolist()
+
+    results = []
+    for title in titles:
+        score = 0
+        if title == query:
+            score += 1000
+        if title.startswith(query):
+            score += 500
+        if query in title:
+            score += 200
+        score += 50 * sum(1 for word in words if word in title)
+        if 10 <= len(title) <= 100:
+            score += 10
+        results.append(score)
+    return results
+
+
+class LocalCatalog:
+    """解決済み候補のカタログ（JSONファイルに永続化）"""
+
+    def __init__(self, path: Optional[str] = None, n: int = 2, min_coverage: float = 1.0,
+                 min_score: int = 500, save_delay: float = 5.0, max_queries: int = 10000):
+        """
+        Args:
+            path: 保存先のJSONファイル（Noneの場合はメモリ上のみ）
+            n: n-gramの文字数
+            min_coverage: 候補とするのに必要な、検索語のn-gramの被覆率
+            min_score: ローカルの結果を採用するのに必要な関連性スコア（500以上で前方一致・完全一致のみ）
+            save_delay: 変更をまとめてファイルへ書き出すまでの待ち時間（秒）
+            max_queries: 保存する検索語の上限（超えたら古いものから捨てる）
+        """
+        self.path = path
+        self.n = n
+        self.min_coverage = min_coverage
+        self.min_score = min_score
+        self.save_delay = save_delay
+        self.max_queries = max_queries
+        # 検索語の正規形 → {'asins': 候補のASIN（順序どおり）, 'max_results': 要求件数, 'fetched_at': 取得日時}
+        self._queries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._entries: List[Dict] = []
+        self._keys: List[str] = []
+        self._by_asin: Dict[str, int] = {}
+        self._index: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+        # ファイルへの書き出しはリクエストの処理とは別スレッドでまとめて行う
+        self._dirty = False
+        self._save_timer: Optional[threading.Timer] = None
+        self._save_lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self._load()
+        if path:
+            atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _load(self):
+        """JSONファイルからカタログを読み込み、インデックスを再構築"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            for entry in data.get('entries', []):
+                # 取得日時のない古い形式のエントリは、期限切れとして扱う
+                self._upsert(entry, entry.get('fetched_at', 0.0))
+            for query, resolved in data.get('queries', {}).items():
+                self._queries[query] = resolved
+            logger.info(f"カタログを読み込みました: {len(self._entries)} 件（検索語 {len(self._queries)} 件）")
+        except (OSError, ValueError) as e:
+            logger.error(f"カタログの読み込みエラー: {e}")
+
+    def _save(self, entries: List[Dict], queries: Dict[str, Dict]):
+        """JSONファイルへ書き出し（一時ファイル経由で置き換え）"""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'entries': entries, 'queries': queries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"カタログの保存エラー: {e}")
+
+    def _upsert(self, candidate: Dict[str, str], fetched_at: float) -> bool:
+        """候補を1件追加・更新（インデックス更新込み）。変更があればTrue"""
+        asin = candidate.get('asin')
+        title = candidate.get('title')
+        if not asin or not title or not candidate.get('thumbnail_url'):
+            return False
+
+        entry = {
+            'asin': asin,
+            'url': candidate.get('url'),
+            'title': title,
+            'thumbnail_url': candidate['thumbnail_url'],
+            'fetched_at': fetched_at,
+        }
+        doc_id = self._by_asin.get(asin)
+        if doc_id is not None:
+            if self._entries[doc_id] == entry:
+                return False
+            # 画像URLや取得日時の更新はインデックスに影響しない
+            if self._entries[doc_id]['title'] == title:
+                self._entries[doc_id] = entry
+                return True
+            for gram in set(char_ngrams(self._keys[doc_id], self.n)):
+                self._index[gram].remove(doc_id)
+        else:
+            doc_id = len(self._entries)
+            self._entries.append(entry)
+            self._keys.append('')
+            self._by_asin[asin] = doc_id
+
+        key = canonicalize_query(title)
+        self._entries[doc_id] = entry
+        self._keys[doc_id] = key
+        for gram in set(char_ngrams(key, self.n)):
+            self._index.setdefault(gram, []).append(doc_id)
+        return True
+
+    def add(self, candidates: Sequence[Dict[str, str]], query: Optional[str] = None,
+            max_results: Optional[int] = None):
+        """
+        解決済み（たった今取得した）候補をカタログに登録
+
+        query（正規形）と max_results を指定すると、その検索の結果として候補の並びも保存します。
+        ファイルへの書き出しは save_delay 秒後にバックグラウンドでまとめて行います。
+        """
+        fetched_at = time.time()
+        with self._lock:
+            changed = False
+            for candidate in candidates:
+                changed = self._upsert(candidate, fetched_at) or changed
+            asins = [c['asin'] for c in candidates if c.get('asin') in self._by_asin]
+            if query and max_results and asins:
+                self._queries[query] = {'asins': asins, 'max_results': max_results, 'fetched_at': fetched_at}
+                self._queries.move_to_end(query)
+                while len(self._queries) > self.max_queries:
+                    self._queries.popitem(last=False)
+                changed = True
+            if changed and self.path:
+                self._dirty = True
+                if self._save_timer is None:
+                    self._save_timer = threading.Timer(self.save_delay, self.flush)
+                    self._save_timer.daemon = True
+                    self._save_timer.start()
+
+    def flush(self):
+        """未保存の変更をJSONファイルへ書き出す（検索はその間も止めない）"""
+        with self._save_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                # エントリは置き換えのみで書き換えないので、浅いコピーで十分
+                entries = list(self._entries)
+                queries = dict(self._queries)
+                self._dirty = False
+            self._save(entries, queries)
+
+    def get(self, asin: str) -> Optional[Dict]:
+        """ASINでカタログを引く（fetched_at は取得日時のUNIX時刻）"""
+        with self._lock:
+            doc_id = self._by_asin.get(asin)
+            return dict(self._entries[doc_id]) if doc_id is not None else None
+
+    def lookup(self, query: str, max_results: int = 5, max_age: Optional[float] = None) -> List[Dict]:
+        """
+        以前に同じ検索語で解決した候補を、そのときの順序で返す
+
+        以前の検索が max_results 件以上を要求していた（または上流にそれだけの候補がなかった）
+        場合だけ返します。取得から max_age 秒を過ぎた検索・候補は使いません。
+        各候補の fetched_at は、候補と検索自体の取得日時の古い方です。
+        """
+        key = canonicalize_query(query)
+        oldest = time.time() - max_age if max_age is not None else float('-inf')
+        with self._lock:
+            resolved = self._queries.get(key)
+            if resolved is None or resolved['fetched_at'] < oldest:
+                return []
+            if resolved['max_results'] < max_results and len(resolved['asins']) >= resolved['max_results']:
+                return []
+            results = []
+            for asin in resolved['asins'][:max_results]:
+                doc_id = self._by_asin.get(asin)
+                if doc_id is None or self._entries[doc_id]['fetched_at'] < oldest:
+                    return []
+                entry = dict(self._entries[doc_id])
+                entry['fetched_at'] = min(entry['fetched_at'], resolved['fetched_at'])
+                results.append(entry)
+            self._queries.move_to_end(key)
+            return results
+
+    def _coverage(self, grams: List[str]) -> Dict[int, float]:
+        """検索語のn-gramのうち、各タイトルが含む割合"""
+        postings = [self._index[g] for g in grams if g in self._index]
+        if not postings:
+            return {}
+
+        if NUMPY_AVAILABLE:
+            counts = np.bincount(np.concatenate([np.asarray(p) for p in postings]),
+                                 minlength=len(self._entries))
+            doc_ids = np.nonzero(counts)[0]
+            return dict(zip(doc_ids.tolist(), (counts[doc_ids] / len(grams)).tolist()))
+
+        counts = Counter(doc_id for p in postings for doc_id in p)
+        return {doc_id: count / len(grams) for doc_id, count in counts.items()}
+
+    def search(self, query: str, max_results: int = 5, max_age: Optional[float] = None) -> List[Dict]:
+        """
+        カタログからタイトル検索
+
+        検索語のn-gramをすべて含み、検索語中の数字（巻数など）がタイトルにも
+        そのまま含まれ、関連性スコアが min_score 以上（前方一致・完全一致）の候補だけを、
+        スコアの高い順に返します（取得から max_age 秒を過ぎた候補は除く）。
+        件数が max_results に満たない場合は、呼び出し側で上流を検索すべきです。
+        """
+        key = canonicalize_query(query)
+        grams = list(set(char_ngrams(key, self.n)))
+        if not grams:
+            return []
+
+        query_numbers = set(_NUMBER_PATTERN.findall(key))
+        oldest = time.time() - max_age if max_age is not None else float('-inf')
+        with self._lock:
+            coverage = self._coverage(grams)
+            doc_ids = [
+                doc_id for doc_id, ratio in coverage.items()
+                if ratio >= self.min_coverage
+                and self._entries[doc_id]['fetched_at'] >= oldest
+                and query_numbers <= set(_NUMBER_PATTERN.findall(self._keys[doc_id]))
+            ]
+            if not doc_ids:
+                return []
+
+            scores = relevance_scores([self._keys[d] for d in doc_ids], key)
+            # 同点の場合は登録順（元の検索結果の順序）を保持
+            ranked: List[Tuple[int, int]] = sorted(
+                ((score, d) for score, d in zip(scores, doc_ids) if score >= self.min_score),
+                key=lambda x: (-x[0], x[1])
+            )
+            return [dict(self._entries[d]) for _, d in ranked[:max_results]]
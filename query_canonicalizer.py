@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+検索クエリの正規化（カノニカライズ）
+全角・半角、空白、括弧、巻数表記などの揺れを吸収し、
+同じ本を指す入力が同じ上流検索・同じキャッシュキーになるようにします。
+"""
+
+import json
+import os
+import re
+import sys
+import unicodedata
+from typing import Dict, Iterable, List
+
+# 区切りとして空白に置き換える記号（NFKC適用後の文字で指定）
+# 「.」は小数点（「8.0」「3.10」）を残すため、数字に挟まれていない場合だけ置き換える
+_SEPARATOR_CHARS = (
+    '「」『』【】〔〕〈〉《》［］()[]{}'
+    '"\'“”‘’`'
+    '、。，．,:;：；!?！？'
+    '・/\\|'
+    '~〜～'
+    '‐‑‒–—―-'
+)
+_SEPARATOR_PATTERN = re.compile('[' + re.escape(_SEPARATOR_CHARS) + r']|(?<![0-9])\.|\.(?![0-9])')
+
+# 巻数表記（「第3巻」「3巻」「vol.3」「#3」など）を数字のみに揃える
+_VOLUME_PATTERNS = [
+    re.compile(r'第\s*0*(\d+)\s*巻'),
+    re.compile(r'(?<![0-9])0*(\d+)\s*巻'),
+    re.compile(r'\b(?:volume|vol)\s*\.?\s*0*(\d+)'),
+    # 「C#」「F#」のように英字・数字に続く「#」は巻数ではない
+    re.compile(r'(?<![a-z0-9+#])#\s*0*(\d+)'),
+]
+
+# 「C# 8.0」「C#8.0」のような、英字に続く「#」の後の空白
+_SHARP_SPACE_PATTERN = re.compile(r'(?<=[a-z]#) +')
+
+# 末尾の単独の数字（巻数）の先頭ゼロ
+_TRAILING_NUMBER_PATTERN = re.compile(r'(?<![0-9])0+(\d+)$')
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# 日本語の文字（かな・カナ・漢字）とその前後の文字の間の空白は区切りとしての意味を
+# 持たないので詰める（日本語の後の数字は巻数なので空白を残し、末尾の「上」「中」「下」も巻として残す）
+_CJK = r'\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff々〆'
+_CJK_SPACE_PATTERN = re.compile(
+    rf'(?:(?<=[{_CJK}]) (?=[^0-9 ])|(?<=[^ ]) (?=[{_CJK}]))(?![上中下]$)'
+)
+
+DEFAULT_FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'fixtures', 'query_variants.json')
+
+
+def normalize_search_text(query: str) -> str:
+    """
+    上流（Amazon）に送る検索語の正規化
+
+    NFKC正規化と空白の統一だけを行い、記号や巻数表記は変えません
+    （正規形はキャッシュやカタログのキーにだけ使い、検索結果を変えないため）。
+    """
+    if not query:
+        return ''
+    return _WHITESPACE_PATTERN.sub(' ', unicodedata.normalize('NFKC', query)).strip()
+
+
+def canonicalize_query(query: str) -> str:
+    """
+    検索クエリを正規形に変換
+
+    1. NFKC正規化（全角英数字→半角、半角カナ→全角、全角空白→半角空白）
+    2. 大文字・小文字の畳み込み
+    3. 巻数表記を数字のみに統一（巻数自体は別の本を指すので残す）
+    4. 括弧や句読点などの記号を空白に統一し、連続する空白を1つにまとめる
+    5. 日本語の文字に隣接する空白を詰める（日本語の後の数字との間の空白は巻数の区切りとして残す）
+    """
+    if not query:
+        return ''
+
+    text = unicodedata.normalize('NFKC', query).casefold()
+
+    for pattern in _VOLUME_PATTERNS:
+        text = pattern.sub(r' \1 ', text)
+
+    text = _SEPARATOR_PATTERN.sub(' ', text)
+    text = _WHITESPACE_PATTERN.sub(' ', text).strip()
+    text = _SHARP_SPACE_PATTERN.sub('', text)
+    text = _TRAILING_NUMBER_PATTERN.sub(r'\1', text)
+    return _CJK_SPACE_PATTERN.sub('', text)
+
+
+def measure_collapse(groups: Iterable[List[str]]) -> Dict[str, float]:
+    """
+    表記揺れのグループ一覧から、正規化でどれだけ上流クエリが減るかを計測
+
+    Args:
+        groups: 同じ本を指す入力文字列のリストのリスト
+
+    Returns:
+        raw_queries: 正規化前の異なるクエリ数
+        canonical_queries: 正規化後の異なるクエリ数
+        collapse_rate: 削減されたクエリの割合
+        split_groups: 1つに集約できなかったグループ数
+        merged_groups: 別の本のグループと衝突した正規形の数
+    """
+    raw_queries = set()
+    canonical_owner: Dict[str, int] = {}
+    split_groups = 0
+    merged = set()
+
+    for index, variants in enumerate(groups):
+        canonical_forms = set()
+        for variant in variants:
+            raw_queries.add(variant)
+            canonical = canonicalize_query(variant)
+            canonical_forms.add(canonical)
+            owner = canonical_owner.setdefault(canonical, index)
+            if owner != index:
+                merged.add(canonical)
+        if len(canonical_forms) > 1:
+            split_groups += 1
+
+    raw_count = len(raw_queries)
+    canonical_count = len(canonical_owner)
+    return {
+        'raw_queries': raw_count,
+        'canonical_queries': canonical_count,
+        'collapse_rate': (1 - canonical_count / raw_count) if raw_count else 0.0,
+        'split_groups': split_groups,
+        'merged_groups': len(merged),
+    }
+
+
+def load_fixture(path: str = DEFAULT_FIXTURE_PATH) -> List[List[str]]:
+    """表記揺れのフィクスチャ（JSON）を読み込む"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return [group['variants'] for group in data]
+
+
+def main():
+    """フィクスチャに対する集約率を表示"""
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FIXTURE_PATH
+    groups = load_fixture(path)
+
+    print("=== クエリ正規化の集約率 ===\n")
+    for variants in groups:
+        canonical_forms = sorted({canonicalize_query(v) for v in variants})
+        mark = "✓" if len(canonical_forms) == 1 else "✗"
+        print(f"{mark} {canonical_forms}  ← {len(variants)}件")
+
+    stats = measure_collapse(groups)
+    print()
+    print(f"正規化前のクエリ数: {stats['raw_queries']}")
+    print(f"正規化後のクエリ数: {stats['canonical_queries']}")
+    print(f"削減率: {stats['collapse_rate']:.1%}")
+    print(f"集約できなかったグループ: {stats['split_groups']}")
+    print(f"別の本と衝突した正規形: {stats['merged_groups']}")
+
+
+if __name__ == "__main__":
+    main()
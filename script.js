@@ -5,6 +5,8 @@
 // クラウドデプロイ後: 'https://your-app-name.onrender.com/api/get-thumbnail'
 // ※ Render 本番環境では必ず /api/get-thumbnail まで含める
 const API_ENDPOINT = 'https://amazon-thumbnail-widget.onrender.com/api/get-thumbnail';
+// APIリクエストのタイムアウト（ミリ秒）
+const REQUEST_TIMEOUT_MS = 60000;
 // DOM要素
 const bookTitleInput = document.getElementById('book-title');
 const searchBtn = document.getElementById('search-btn');
@@ -100,14 +102,16 @@ async function fetchThumbnailFromBackend(title) {
         const requestBody = { 
             title: title || null,
             isbn: null,
-            max_results: 5  // 最大5件の候補を取得
+            max_results: 5,  // 最大5件の候補を取得
+            // サーバー側の期限（ブラウザが中断する前に応答が返るよう少し短めにする）
+            timeout_ms: REQUEST_TIMEOUT_MS - 5000
         };
         
         console.log('APIリクエスト送信:', requestBody);
         
-        // タイムアウトを60秒に設定
+        // タイムアウトを設定
         const controller = new AbortController();
-        const timeoutId = setTimeout(() => controller.abort(), 60000);
+        const timeoutId = setTimeout(() => controller.abort(), REQUEST_TIMEOUT_MS);
         
         const response = await fetch(API_ENDPOINT, {
             method: 'POST',